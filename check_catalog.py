@@ -7,7 +7,7 @@ import json
 import sqlite3
 import datetime
 import glob
-import requests
+import httpclient
 
 MAP_DATE = '2019-10-08'
 CATALOG = './map-catalog.json'
@@ -41,15 +41,15 @@ def process_catalog_list(map):
             sys.exit(1)
     
 def check_url(url):
-    r = requests.head(url)
-    if r.status_code < 400:
+    r = httpclient.shared().request("HEAD",url)
+    if r.status < 400:
         return True
     return False
 
 outstr = ''
-r = requests.get(CATALOG_URL)
-if r.status_code < 400:
-    map = r.text
+r = httpclient.shared().request("GET",CATALOG_URL)
+if r.status < 400:
+    map = r.data.decode('utf-8')
 else:
     print('Failed to open %s'%CATALOG_URL)
     sys.exit(1)
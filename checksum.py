@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# Hash mbtiles files in parallel, keep md5 and sha256 sidecars, skip files that have not changed
+
+# Each file is read once, in BLOCKs, into both md5 and sha256. Files are
+#   hashed by a pool of threads, hashlib lets go of the GIL on large blocks,
+#   so the limit is the disks rather than one core.
+# Results are kept in a cache, a json file in each directory (CACHE), keyed
+#   on the path and checked against its size and mtime. A file whose size and
+#   mtime match is not read again. The cache is saved as each file finishes,
+#   so a run that is stopped keeps what it has done.
+# Sidecars are NAME.md5 and NAME.sha256, in the format of md5sum and
+#   sha256sum (hash, two spaces, path), and are written only when they differ.
+# remember() adds a file hashed elsewhere, as fetchmap.py does for what it
+#   downloads.
+
+import os, sys
+import argparse
+import glob
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+PREFIX = '/hd/maps/maps-2020/staged'
+CACHE = '.checksums.json'
+BLOCK = 4 * 1024 * 1024
+WORKERS = 4
+ALGORITHMS = ('md5','sha256')
+
+cache_lock = threading.Lock()
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Write md5 and sha256 sidecars of mbtiles files.")
+   parser.add_argument("paths", nargs='*', help="Files or directories of *.mbtiles. (Default=%s)"%PREFIX)
+   parser.add_argument("-w", "--workers", help="Files hashed at once. (Default=%s)"%WORKERS, type=int,
+                       default=WORKERS)
+   parser.add_argument("-f", "--force", help="Hash every file, even if unchanged.", action='store_true')
+   return parser.parse_args()
+
+def file_hashes(path):
+   # {'md5': hex, 'sha256': hex}, in one pass over the file
+   digests = dict([(name, hashlib.new(name)) for name in ALGORITHMS])
+   with open(path,'rb') as file_fp:
+      for block in iter(lambda: file_fp.read(BLOCK), b''):
+         for digest in digests.values():
+            digest.update(block)
+   return dict([(name, digest.hexdigest()) for (name, digest) in digests.items()])
+
+def cache_path(path):
+   return os.path.join(os.path.dirname(os.path.abspath(path)), CACHE)
+
+def load_cache(path):
+   try:
+      with open(path,'r') as cache_fp:
+         return json.loads(cache_fp.read())
+   except (OSError, ValueError):
+      return {}
+
+def save_cache(path, cache):
+   with open(path + '.tmp','w') as cache_fp:
+      cache_fp.write(json.dumps(cache, indent=2, sort_keys=True))
+   os.replace(path + '.tmp', path)
+
+def signature(path):
+   stat = os.stat(path)
+   return { 'size': stat.st_size, 'mtime': stat.st_mtime_ns }
+
+def cached(cache, path):
+   # the hashes, if the file has not changed since they were taken
+   entry = cache.get(os.path.abspath(path))
+   if entry is None:
+      return None
+   sig = signature(path)
+   if entry.get('size') != sig['size'] or entry.get('mtime') != sig['mtime']:
+      return None
+   if not all([name in entry for name in ALGORITHMS]):
+      return None
+   return dict([(name, entry[name]) for name in ALGORITHMS])
+
+def write_sidecars(path, hashes):
+   for name in ALGORITHMS:
+      line = '%s  %s\n'%(hashes[name],os.path.abspath(path))
+      sidecar = path + '.' + name
+      if os.path.isfile(sidecar):
+         with open(sidecar,'r') as sidecar_fp:
+            if sidecar_fp.read() == line:
+               continue
+      with open(sidecar,'w') as sidecar_fp:
+         sidecar_fp.write(line)
+
+def remember(path, hashes):
+   # for a file hashed as it was written, sig taken now
+   cpath = cache_path(path)
+   with cache_lock:
+      cache = load_cache(cpath)
+      entry = signature(path)
+      entry.update(hashes)
+      cache[os.path.abspath(path)] = entry
+      save_cache(cpath, cache)
+   write_sidecars(path, hashes)
+
+def expand(paths):
+   # directories stand for their *.mbtiles
+   files = []
+   for path in paths:
+      if os.path.isdir(path):
+         files += sorted(glob.glob(os.path.join(path, '*.mbtiles')))
+      else:
+         files.append(path)
+   return files
+
+def checksum(paths, workers=WORKERS, force=False):
+   # {path: {'md5': hex, 'sha256': hex}} for every file, hashing only those
+   #   that changed, and writes the sidecars
+   caches = {} # cache path -> cache
+   results = {}
+   todo = []
+   for path in expand(paths):
+      cpath = cache_path(path)
+      if cpath not in caches:
+         caches[cpath] = load_cache(cpath)
+      hashes = None if force else cached(caches[cpath], path)
+      if hashes is None:
+         todo.append(path)
+      else:
+         results[path] = hashes
+   if todo:
+      print('%s of %s files to hash'%(len(todo),len(todo) + len(results)))
+   start = time.time()
+   read = 0
+   with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+      # the signature is taken before the read, a file that changes while it
+      #   is read is hashed again next time
+      futures = dict([(pool.submit(file_hashes, path), (path, signature(path))) for path in todo])
+      for future in as_completed(futures):
+         (path, sig) = futures[future]
+         hashes = future.result()
+         results[path] = hashes
+         read += sig['size']
+         cpath = cache_path(path)
+         entry = dict(sig)
+         entry.update(hashes)
+         caches[cpath][os.path.abspath(path)] = entry
+         with cache_lock:
+            save_cache(cpath, caches[cpath])
+         print('%s %s'%(hashes['md5'],path))
+   if todo:
+      seconds = time.time() - start
+      print('%s MB hashed in %0.1f seconds, %0.1f MB/s'%(read // 1000000,seconds,read / max(seconds, 0.001) / 1e6))
+   for (path, hashes) in results.items():
+      write_sidecars(path, hashes)
+   return results
+
+def main():
+   args = parse_args()
+   paths = args.paths or [PREFIX]
+   for path in paths:
+      if not os.path.exists(path):
+         print('Failed to open %s -- Quitting'%path)
+         sys.exit(1)
+   results = checksum(paths, args.workers, args.force)
+   print('%s files checked'%len(results))
+
+if __name__ == "__main__":
+   main()
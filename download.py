@@ -15,17 +15,27 @@ import argparse
 from PIL import Image
 from io import BytesIO
 import curses
-import certifi
-import urllib3
 import tools
 import subprocess
 import json
-import math
-import uuid
 import shutil
-from multiprocessing import Process, Lock
+import threading
+import urllib.parse
+from collections import OrderedDict
+from functools import partial
 import time
 from datetime import datetime
+from fetch import TileFetcher, WORKERS
+from journal import Journal
+import plan
+import verify
+import export
+import pyramid
+import ocean
+import sources
+import httpclient
+import upstream
+from wmts import WMTS, tile_hash
 
 
 # Download source of satellite imagry
@@ -33,8 +43,7 @@ url =  "https://tiles.maps.eox.at/wmts?layer=s2cloudless-2020_3857&style=default
 ATTRIBUTION = os.environ.get('METADATA_ATTRIBUTION', '<a href="http://openmaptiles.org/" target="_blank">&copy; OpenMapTiles</a> <a href="http://www.openstreetmap.org/about/" target="_blank">&copy; OpenStreetMap contributors</a>')
 VERSION = os.environ.get('METADATA_VERSION', '3.3')
 src = object # the open url source
-# tiles smaller than this are probably ocean
-threshold = 2000
+urls = [url] # mirrors, in order of preference, set by -g
 
 # GLOBALS
 mbTiles = object
@@ -48,14 +57,49 @@ config_fn = 'config.json'
 config = {}
 earth_around = 40075 # in KM
 tile_metadata = {}
+flat_tiles = None # ocean.Sparse of the file being written
+validators = None # upstream.Validators of the file being written
+# tiles buffered by MBTiles.writer() before one transaction is committed
+BATCH_SIZE = 500
+# applied while a writer is open, the previous values are restored on close
+WRITER_PRAGMAS = { 'journal_mode': 'WAL', 'synchronous': 'NORMAL' }
+# get_bounds looks at zooms 0 to this
+MAX_ZOOM = 22
+BOUNDS_SNAPSHOT = './work/bounds.json'
+# bytes of tiles kept by an MBTilesReader
+READER_CACHE = 64 * 1024 * 1024
+# bytes of the file an MBTilesReader has sqlite map into memory
+READER_MMAP = 1024 * 1024 * 1024
+# how closely downloaded tiles are checked, one of verify.LEVELS
+check_level = 'structure'
+# rows are stored as the WMTS source numbers them, written to metadata as
+#   'scheme' so that readers (serve.py) need not guess
+SCHEME = 'xyz'
 
 class MBTiles():
    def __init__(self, filename):
+      self.filename = filename
       self.conn = sqlite3.connect(filename)
       self.conn.row_factory = sqlite3.Row
       self.conn.text_factory = str
       self.c = self.conn.cursor()
       self.schemaReady = False
+      self.indexesReady = False
+
+   def SetPragmas(self, pragmas):
+      # returns the previous values so that they can be restored
+      self.conn.commit() # journal_mode cannot change inside a transaction
+      previous = {}
+      for name in pragmas:
+         previous[name] = self.c.execute('PRAGMA %s'%name).fetchone()[0]
+         self.c.execute('PRAGMA %s = %s'%(name,pragmas[name]))
+      return previous
+
+   def writer(self, batch_size=BATCH_SIZE, pragmas=WRITER_PRAGMAS, journal=None):
+      return TileWriter(self, batch_size, pragmas, journal)
+
+   def reader(self, cache_bytes=READER_CACHE, immutable=False):
+      return MBTilesReader(self.filename, cache_bytes, immutable)
 
    def __del__(self):
       self.conn.commit()
@@ -78,7 +122,7 @@ class MBTiles():
       row = rows[0]
       return row[0]
 
-   def CheckSchema(self):     
+   def CheckSchema(self, indexes=True):
       sql = 'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_id TEXT,grid_id TEXT)'
       self.c.execute(sql)
 
@@ -94,8 +138,59 @@ class MBTiles():
       sql = 'CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id'
       self.c.execute(sql)
 
+      if indexes and not self.indexesReady:
+         self.AddIndexes()
       self.schemaReady = True
 
+   def HasUniqueIndex(self, table, columns):
+      for index in self.c.execute('PRAGMA index_list(%s)'%table).fetchall():
+         if not index['unique']:
+            continue
+         info = self.c.execute('PRAGMA index_info("%s")'%index['name']).fetchall()
+         if [row['name'] for row in info] == columns:
+            return True
+      return False
+
+   def AddIndexes(self):
+      # Same unique indexes as create_structure in merge_regions. Older files
+      #   may hold duplicates, which would stop the index being created, so
+      #   the newest row (highest rowid) is kept and the rest deleted first.
+      # Run by --index, and before the first write (SetTiles, a writer), never
+      #   from the paths that only read the file.
+      if not self.HasUniqueIndex('map',['zoom_level','tile_column','tile_row']):
+         if self.c.execute('SELECT 1 FROM map LIMIT 1').fetchone():
+            print('Adding unique index to map, this is done once per file')
+         self.c.execute('CREATE TEMP TABLE IF NOT EXISTS replaced (tile_id TEXT)')
+         with self.conn:
+            duplicates = '''rowid NOT IN (SELECT max(rowid) FROM map GROUP BY zoom_level, tile_column, tile_row)'''
+            # only the images of the rows removed here may be left unused
+            self.c.execute('INSERT INTO temp.replaced SELECT tile_id FROM map WHERE ' + duplicates)
+            self.c.execute('DELETE FROM map WHERE ' + duplicates)
+            if self.c.rowcount > 0:
+               print('Removed %s duplicate tiles from map'%self.c.rowcount)
+               self.c.execute("DELETE FROM satdata WHERE name = 'bounds'")
+               self.c.execute('CREATE INDEX IF NOT EXISTS map_tile_id_index ON map (tile_id)')
+               self.c.execute('''DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM temp.replaced)
+                     AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id)''')
+               print('Removed %s images no longer used'%self.c.rowcount)
+            self.c.execute('DELETE FROM temp.replaced')
+            self.c.execute('DROP INDEX IF EXISTS map_index')
+            self.c.execute('CREATE UNIQUE INDEX map_index ON map (zoom_level,tile_column,tile_row)')
+      if not self.HasUniqueIndex('images',['tile_id']):
+         if self.c.execute('SELECT 1 FROM images LIMIT 1').fetchone():
+            print('Adding unique index to images, this is done once per file')
+         with self.conn:
+            self.c.execute('''DELETE FROM images WHERE rowid NOT IN (SELECT max(rowid) FROM images
+                  GROUP BY tile_id)''')
+            if self.c.rowcount > 0:
+               print('Removed %s duplicate images'%self.c.rowcount)
+            self.c.execute('DROP INDEX IF EXISTS images_index')
+            self.c.execute('CREATE UNIQUE INDEX images_index ON images (tile_id)')
+      # images are shared, this finds the other users of an image
+      self.c.execute('CREATE INDEX IF NOT EXISTS map_tile_id_index ON map (tile_id)')
+      self.conn.commit()
+      self.indexesReady = True
+
    def GetAllMetaData(self):
       rows = self.c.execute("SELECT name, value FROM metadata")
       out = {}
@@ -105,7 +200,7 @@ class MBTiles():
 
    def SetMetaData(self, name, value):
       if not self.schemaReady:
-         self.CheckSchema()
+         self.CheckSchema(indexes=False)
 
       self.c.execute("UPDATE metadata SET value=? WHERE name=?", (value, name))
       if self.c.rowcount == 0:
@@ -115,7 +210,7 @@ class MBTiles():
 
    def DeleteMetaData(self, name):
       if not self.schemaReady:
-         self.CheckSchema()
+         self.CheckSchema(indexes=False)
 
       self.c.execute("DELETE FROM metadata WHERE name = ?", (name,))
       self.conn.commit()
@@ -124,7 +219,7 @@ class MBTiles():
 
    def SetSatMetaData(self, zoomLevel, name, value):
       if not self.schemaReady:
-         self.CheckSchema()
+         self.CheckSchema(indexes=False)
 
       self.c.execute("UPDATE satdata SET value=? WHERE zoom_level=? AND name = ?", (value, zoomLevel, name))
       if self.c.rowcount == 0:
@@ -141,60 +236,100 @@ class MBTiles():
 
    def DeleteSatData(self, zoomLevel, name):
       if not self.schemaReady:
-         self.CheckSchema()
+         self.CheckSchema(indexes=False)
 
-      self.c.execute("DELETE FROM satdata WHERE name = ? AND zoom_level = ?", (zoomLevel, name,))
+      self.c.execute("DELETE FROM satdata WHERE name = ? AND zoom_level = ?", (name, zoomLevel,))
       self.conn.commit()
       if self.c.rowcount == 0:
          raise RuntimeError("SatData name %s not found"%name)
 
    def SetTile(self, zoomLevel, tileColumn, tileRow, data):
-      if not self.schemaReady:
+      self.SetTiles([(zoomLevel, tileColumn, tileRow, data)])
+
+   def SetTiles(self, tiles):
+      # tiles is a list of (zoom_level, tile_column, tile_row, tile_data)
+      #   written as one transaction, existing tiles are replaced
+      # the upsert needs the unique index on map, see AddIndexes
+      if not self.indexesReady:
          self.CheckSchema()
 
-      tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
-      if tile_id: 
-         tile_id = uuid.uuid4().hex
-         operation = 'update images'
-         self.c.execute("DELETE FROM images  WHERE tile_id = ?;", ([tile_id]))
-         self.c.execute("INSERT INTO images (tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
-         self.c.execute("""UPDATE map SET tile_id=? where zoom_level = ? AND 
-               tile_column = ? AND tile_row = ?;""", 
-            (tile_id, zoomLevel, tileColumn, tileRow))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
-         self.conn.commit()
-         return
-      else: # this is not an update
-         tile_id = uuid.uuid4().hex
-         self.c.execute("INSERT INTO images ( tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Insert image failure")
-         operation = 'insert into map'
-         self.c.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);", 
-            (zoomLevel, tileColumn, tileRow, tile_id))
-      if self.c.rowcount != 1:
-         raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
-      self.conn.commit()
-   
+      latest = {} # the last copy of a tile in the batch wins
+      for (zoomLevel, tileColumn, tileRow, data) in tiles:
+         latest[(zoomLevel, tileColumn, tileRow)] = data
+      keys = []
+      images = []
+      rows = []
+      for (zoomLevel, tileColumn, tileRow), data in latest.items():
+         tile_id = tile_hash(data)
+         keys.append((zoomLevel, tileColumn, tileRow))
+         images.append((sqlite3.Binary(data), tile_id))
+         rows.append((zoomLevel, tileColumn, tileRow, tile_id))
+      self.c.execute('CREATE TEMP TABLE IF NOT EXISTS replaced (tile_id TEXT)')
+      with self.conn:
+         # note the images being replaced, they are deleted if no longer used
+         self.c.executemany("""INSERT INTO temp.replaced SELECT tile_id FROM map
+               WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;""", keys)
+         self.c.executemany("INSERT OR IGNORE INTO images (tile_data,tile_id) VALUES (?, ?);", images)
+         self.c.executemany("""INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)
+               ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_id = excluded.tile_id;""",
+            rows)
+         if self.c.rowcount != len(rows):
+            raise RuntimeError("Failure insert into map RowCount:%s"%self.c.rowcount)
+         self.c.execute("""DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM temp.replaced)
+               AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id);""")
+         self.c.execute('DELETE FROM temp.replaced')
+         self.StaleStats([key[0] for key in keys])
+
+   def Dedupe(self):
+      # rewrite older files, whose tile_ids are random, to content hashes
+      #   and keep one copy of each image, UPDATE OR IGNORE needs images_index
+      if not self.indexesReady:
+         self.CheckSchema()
+      before = self.c.execute('SELECT count(*) FROM images').fetchone()[0]
+      self.c.execute('CREATE TEMP TABLE IF NOT EXISTS idmap (old_id TEXT PRIMARY KEY, new_id TEXT)')
+      self.c.execute('DELETE FROM temp.idmap')
+      batch = []
+      for row in self.conn.execute('SELECT tile_id, tile_data FROM images'):
+         new_id = tile_hash(row[1])
+         if new_id != row[0]:
+            batch.append((row[0], new_id))
+         if len(batch) >= BATCH_SIZE:
+            self.c.executemany('INSERT INTO temp.idmap (old_id, new_id) VALUES (?, ?)', batch)
+            batch = []
+      self.c.executemany('INSERT INTO temp.idmap (old_id, new_id) VALUES (?, ?)', batch)
+      with self.conn:
+         self.c.execute("""UPDATE map SET tile_id = (SELECT new_id FROM temp.idmap WHERE old_id = map.tile_id)
+               WHERE tile_id IN (SELECT old_id FROM temp.idmap)""")
+         # the first image with a given hash takes it, the others stay behind
+         self.c.execute("""UPDATE OR IGNORE images SET tile_id = (SELECT new_id FROM temp.idmap
+               WHERE old_id = images.tile_id) WHERE tile_id IN (SELECT old_id FROM temp.idmap)""")
+         self.c.execute('DELETE FROM images WHERE tile_id IN (SELECT old_id FROM temp.idmap)')
+         self.c.execute('DELETE FROM images WHERE NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id)')
+         self.c.execute('DELETE FROM temp.idmap')
+      after = self.c.execute('SELECT count(*) FROM images').fetchone()[0]
+      print('Images before:%s after:%s'%(before,after))
+      self.c.execute('vacuum')
+
 
    def DeleteTile(self, zoomLevel, tileColumn, tileRow):
       if not self.schemaReady:
-         self.CheckSchema()
+         self.CheckSchema(indexes=False)
 
       tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
       if not tile_id:
          raise RuntimeError("Tile not found")
 
-      self.c.execute("DELETE FROM images WHERE tile_id = ?;",tile_id) 
-      self.c.execute("DELETE FROM map WHERE tile_id = ?;",tile_id) 
+      # the image may be shared with other tiles
+      self.c.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+            (zoomLevel, tileColumn, tileRow))
+      self.c.execute("DELETE FROM images WHERE tile_id = ? AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = ?);",
+            (tile_id, tile_id))
+      self.StaleStats([zoomLevel])
       self.conn.commit()
 
    def TileExists(self, zoomLevel, tileColumn, tileRow):
       if not self.schemaReady:
-         self.CheckSchema()
+         self.CheckSchema(indexes=False)
 
       sql = 'select tile_id from map where zoom_level = ? and tile_column = ? and tile_row = ?'
       self.c.execute(sql,(zoomLevel, tileColumn, tileRow))
@@ -228,28 +363,123 @@ class MBTiles():
    def Commit(self):
       self.conn.commit()
 
+   def HasTable(self, name):
+      return self.c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,)).fetchone() is not None
+
+   def HasZoomIndex(self):
+      # map_index, or any index led by zoom_level, makes one zoom a range scan
+      for index in self.c.execute('PRAGMA index_list(map)').fetchall():
+         info = self.c.execute('PRAGMA index_info("%s")'%index['name']).fetchall()
+         if info and info[0]['name'] == 'zoom_level':
+            return True
+      return False
+
+   def CachedStats(self):
+      # {zoom: stats} kept in satdata as 'bounds', empty if there is no satdata
+      if not self.HasTable('satdata'):
+         return {}
+      rows = self.c.execute("SELECT zoom_level, value FROM satdata WHERE name = 'bounds'").fetchall()
+      return dict([(int(row[0]), json.loads(row[1])) for row in rows])
+
+   def CacheStats(self, stats):
+      # only into a satdata table already there, a file that is only read is
+      #   not given tables it did not have
+      if not stats or not self.HasTable('satdata'):
+         return
+      try:
+         with self.conn:
+            self.c.executemany("DELETE FROM satdata WHERE zoom_level = ? AND name = 'bounds'",
+                  [(zoom,) for zoom in stats])
+            self.c.executemany("INSERT INTO satdata (zoom_level, name, value) VALUES (?, 'bounds', ?)",
+                  [(zoom, json.dumps(stats[zoom])) for zoom in stats])
+      except sqlite3.OperationalError:
+         pass # read only
+
+   def ZoomStats(self, zoom):
+      # {'minX','maxX','minY','maxY','count'} of one zoom, read from map_index
+      #   alone. The result is kept in satdata as 'bounds' until a write to
+      #   the zoom removes it (StaleStats), so later calls are one lookup.
+      cached = self.CachedStats()
+      if zoom in cached:
+         return cached[zoom]
+      stats = self.ReadZoomStats(zoom)
+      self.CacheStats({ zoom: stats })
+      return stats
+
+   def ReadZoomStats(self, zoom):
+      sql = 'SELECT min(tile_column),max(tile_column),min(tile_row),max(tile_row),count(*) FROM map WHERE zoom_level = ?'
+      row = self.c.execute(sql, (zoom,)).fetchone()
+      return { 'minX': row[0], 'maxX': row[1], 'minY': row[2], 'maxY': row[3], 'count': row[4] }
+
+   def AllZoomStats(self):
+      # ZoomStats of every zoom to MAX_ZOOM. Without an index on zoom_level
+      #   each zoom would be a scan of map, so the zooms not cached are read
+      #   in one GROUP BY instead.
+      stats = self.CachedStats()
+      missing = [zoom for zoom in range(MAX_ZOOM + 1) if zoom not in stats]
+      if not missing:
+         return stats
+      if self.HasZoomIndex():
+         found = dict([(zoom, self.ReadZoomStats(zoom)) for zoom in missing])
+      else:
+         found = dict([(zoom, { 'minX': None, 'maxX': None, 'minY': None, 'maxY': None, 'count': 0 })
+               for zoom in missing])
+         sql = 'SELECT zoom_level,min(tile_column),max(tile_column),min(tile_row),max(tile_row),count(*) FROM map'
+         for row in self.c.execute(sql + ' GROUP BY zoom_level').fetchall():
+            if row[0] in found:
+               found[row[0]] = { 'minX': row[1], 'maxX': row[2], 'minY': row[3], 'maxY': row[4], 'count': row[5] }
+      self.CacheStats(found)
+      stats.update(found)
+      return stats
+
+   def StaleStats(self, zooms=None):
+      # forget the cached ZoomStats of these zooms, all of them if None
+      if not self.schemaReady:
+         self.CheckSchema(indexes=False)
+      if zooms is None:
+         self.c.execute("DELETE FROM satdata WHERE name = 'bounds'")
+      else:
+         self.c.executemany("DELETE FROM satdata WHERE zoom_level = ? AND name = 'bounds'",
+               [(zoom,) for zoom in set(zooms)])
+
+   def Stamp(self):
+      # changes whenever the file, or its write ahead log, is written
+      stamp = []
+      for path in (self.filename, self.filename + '-wal'):
+         if os.path.exists(path):
+            info = os.stat(path)
+            stamp += [info.st_mtime_ns, info.st_size]
+      return stamp
+
    def get_bounds(self):
+     # ./work/bounds.json is a snapshot, used while the file is unchanged
      global bounds
-     sql = 'select zoom_level, min(tile_column),max(tile_column),min(tile_row),max(tile_row), count(zoom_level) from tiles group by zoom_level;'
-     resp = self.c.execute(sql)
-     rows = resp.fetchall()
-     for row in rows:
-         bounds[row['zoom_level']] = { 'minX': row['min(tile_column)'],\
-                                  'maxX': row['max(tile_column)'],\
-                                  'minY': row['min(tile_row)'],\
-                                  'maxY': row['max(tile_row)'],\
-                                  'count': row['count(zoom_level)'],\
-                                 }
-     outstr = json.dumps(bounds,indent=2)
-     # diagnostic info
-     with open('./work/bounds.json','w') as bounds_fp:
-        bounds_fp.write(outstr)
+     bounds.clear()
+     try:
+        with open(BOUNDS_SNAPSHOT,'r') as bounds_fp:
+           snapshot = json.loads(bounds_fp.read())
+        if snapshot['filename'] == os.path.abspath(self.filename) and snapshot['stamp'] == self.Stamp():
+           for zoom in snapshot['bounds']:
+              bounds[int(zoom)] = snapshot['bounds'][zoom]
+           return bounds
+     except (OSError, ValueError, KeyError):
+        pass
+     for (zoom, stats) in sorted(self.AllZoomStats().items()):
+         if stats['count'] > 0:
+            bounds[zoom] = stats
+     self.Commit()
+     snapshot = { 'filename': os.path.abspath(self.filename), 'stamp': self.Stamp(), 'bounds': bounds }
+     if os.path.isdir(os.path.dirname(BOUNDS_SNAPSHOT)):
+        with open(BOUNDS_SNAPSHOT,'w') as bounds_fp:
+           bounds_fp.write(json.dumps(snapshot,indent=2))
      return bounds
 
    def summarize(self):
-     sql = 'select zoom_level, min(tile_column),max(tile_column),min(tile_row),max(tile_row), count(zoom_level) from tiles group by zoom_level;'
-     self.c.execute(sql)
-     rows = self.c.fetchall()
+     rows = []
+     for (zoom, stats) in sorted(self.AllZoomStats().items()):
+         if stats['count'] > 0:
+            rows.append((zoom,stats['minX'],stats['maxX'],stats['minY'],stats['maxY'],stats['count']))
      print('Zoom Levels Found:%s'%len(rows))
      for row in rows:
        if row[2] != None and row[1] != None and row[3] != None and row[4] != None:
@@ -264,11 +494,7 @@ class MBTiles():
          
   
    def CountTiles(self,zoom):
-      self.c.execute("select tile_data from tiles where zoom_level = ?",(zoom,))
-      num = 0
-      while self.c.fetchone():
-         num += 1 
-      return num
+      return self.ZoomStats(zoom)['count']
 
    def execute_script(self,script):
       self.c.executescript(script)
@@ -276,8 +502,9 @@ class MBTiles():
    def copy_zoom(self,zoom,src):
       sql = 'ATTACH DATABASE "%s" as src'%src
       self.c.execute(sql)
-      sql = 'INSERT INTO map SELECT * from src.map where src.map.zoom_level=?'
+      sql = 'INSERT OR REPLACE INTO map SELECT * from src.map where src.map.zoom_level=?'
       self.c.execute(sql,[zoom])
+      self.StaleStats([zoom])
       sql = 'INSERT OR IGNORE INTO images SELECT src.images.tile_data, src.images.tile_id from src.images JOIN src.map ON src.map.tile_id = src.images.tile_id where map.zoom_level=?'
       self.c.execute(sql,[zoom])
       sql = 'DETACH DATABASE src'
@@ -286,10 +513,11 @@ class MBTiles():
    def copy_mbtile(self,src):
       sql = 'ATTACH DATABASE "%s" as src'%src
       self.c.execute(sql)
-      sql = 'INSERT INTO map SELECT * from src.map where true'
-      self.c.execute(sql,[zoom])
+      sql = 'INSERT OR REPLACE INTO map SELECT * from src.map where true'
+      self.c.execute(sql)
+      self.StaleStats()
       sql = 'INSERT OR IGNORE INTO images SELECT src.images.tile_data, src.images.tile_id from src.images JOIN src.map ON src.map.tile_id = src.images.tile_id where true'
-      self.c.execute(sql,[zoom])
+      self.c.execute(sql)
       sql = 'DETACH DATABASE src'
       self.c.execute(sql)
 
@@ -298,26 +526,163 @@ class MBTiles():
       self.c.execute(sql,[zoom])
       sql = 'DELETE FROM map where zoom_level=?'
       self.c.execute(sql,[zoom])
+      self.StaleStats([zoom])
       sql = "vacuum"
       self.c.execute(sql)
       self.Commit()
 
-class WMTS(object):
-
-   def __init__(self, template):
-      self.template = template
-      self.http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED',\
-           ca_certs=certifi.where(),maxsize=10)
-
-   def get(self,z,x,y):
-      srcurl = "%s"%self.template
-      srcurl = srcurl.replace('{z}',str(z))
-      srcurl = srcurl.replace('{x}',str(x))
-      srcurl = srcurl.replace('{y}',str(y))
-      #print(srcurl[-50:])
-      resp = (self.http.request("GET",srcurl,retries=10))
-      return(resp)
-      
+class MBTilesReader(object):
+   # Read only access to an mbtiles, for viewers, exporters and servers
+   #   reader = mbTiles.reader()
+   #   data = reader.GetTile(zoom, x, y)
+   # The file is opened mode=ro, and pages are read through mmap. With
+   #   immutable=True sqlite also skips locking and change checks, only for
+   #   files nothing is writing. Tiles are looked up in map and images, not
+   #   through the tiles view, and the most recently used are kept, up to
+   #   cache_bytes in all.
+   # Safe to share between threads, each thread gets its own connection from
+   #   the pool, and they share the cache.
+
+   def __init__(self, filename, cache_bytes=READER_CACHE, immutable=False, mmap_size=READER_MMAP):
+      self.filename = filename
+      self.uri = 'file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(filename))
+      if immutable:
+         self.uri += '&immutable=1'
+      self.mmap_size = mmap_size
+      self.local = threading.local()
+      self.conns = []
+      self.lock = threading.Lock()
+      self.cache = OrderedDict() # (zoom, x, y) -> (tile_id, tile_data), oldest first
+      self.cache_bytes = cache_bytes
+      self.cached = 0
+      self.hits = 0
+      self.misses = 0
+
+   def connection(self):
+      conn = getattr(self.local, 'conn', None)
+      if conn is None:
+         conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+         conn.execute('PRAGMA mmap_size = %s'%self.mmap_size)
+         self.local.conn = conn
+         with self.lock:
+            self.conns.append(conn)
+      return conn
+
+   def Cached(self, zoomLevel, tileColumn, tileRow):
+      # (tile_id, tile_data) if the tile is in the cache, else None
+      key = (zoomLevel, tileColumn, tileRow)
+      with self.lock:
+         if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+      return None
+
+   def GetTileAndId(self, zoomLevel, tileColumn, tileRow):
+      # returns (tile_id, tile_data), the tile_id serves as a version of the tile
+      tile = self.Cached(zoomLevel, tileColumn, tileRow)
+      if tile:
+         return tile
+      key = (zoomLevel, tileColumn, tileRow)
+      row = self.connection().execute('''SELECT map.tile_id, images.tile_data FROM map
+            JOIN images ON images.tile_id = map.tile_id
+            WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?''', key).fetchone()
+      if row is None:
+         raise RuntimeError("Tile not found")
+      tile = (row[0], row[1])
+      with self.lock:
+         self.misses += 1
+         if key not in self.cache:
+            self.cache[key] = tile
+            self.cached += len(tile[1])
+         while self.cached > self.cache_bytes and len(self.cache) > 1:
+            (old, old_tile) = self.cache.popitem(last=False)
+            self.cached -= len(old_tile[1])
+      return tile
+
+   def GetTile(self, zoomLevel, tileColumn, tileRow):
+      return self.GetTileAndId(zoomLevel, tileColumn, tileRow)[1]
+
+   def GetAllMetaData(self):
+      out = {}
+      try:
+         for row in self.connection().execute("SELECT name, value FROM metadata"):
+            out[row[0]] = row[1]
+      except sqlite3.OperationalError:
+         pass # no metadata table
+      return out
+
+   def Forget(self, zoomLevel, tileColumn, tileRow):
+      # after the tile is written through another connection
+      with self.lock:
+         tile = self.cache.pop((zoomLevel, tileColumn, tileRow), None)
+         if tile is not None:
+            self.cached -= len(tile[1])
+
+   def close(self):
+      with self.lock:
+         for conn in self.conns:
+            conn.close()
+         self.conns = []
+
+class TileWriter(object):
+   # Buffers tiles for an MBTiles, each batch is written in one transaction
+   #   with mbTiles.writer(batch_size=1000) as writer:
+   #      writer.put(zoom, x, y, data)
+   # With a journal, tiles are marked done (or the state given to put) once
+   #   their batch is committed
+
+   def __init__(self, mbtiles, batch_size=BATCH_SIZE, pragmas=WRITER_PRAGMAS, journal=None):
+      self.mbtiles = mbtiles
+      self.batch_size = batch_size
+      self.pragmas = pragmas
+      self.journal = journal
+      self.saved_pragmas = {}
+      self.pending = []
+      self.states = []
+      self.written = 0
+
+   def __enter__(self):
+      return self.open()
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      # tiles already fetched are good, keep them even if the caller failed
+      self.close()
+      return False
+
+   def open(self):
+      if not self.mbtiles.indexesReady:
+         self.mbtiles.CheckSchema()
+      if self.pragmas:
+         self.saved_pragmas = self.mbtiles.SetPragmas(self.pragmas)
+      return self
+
+   def close(self):
+      self.flush()
+      if self.journal:
+         self.journal.save()
+      if self.saved_pragmas:
+         self.mbtiles.SetPragmas(self.saved_pragmas)
+         self.saved_pragmas = {}
+
+   def put(self, zoomLevel, tileColumn, tileRow, data, state='done'):
+      self.pending.append((zoomLevel, tileColumn, tileRow, data))
+      self.states.append(state)
+      if len(self.pending) >= self.batch_size:
+         self.flush()
+
+   def flush(self):
+      if len(self.pending) == 0:
+         return
+      self.mbtiles.SetTiles(self.pending)
+      if self.journal:
+         for ((zoomLevel, tileColumn, tileRow, data), state) in zip(self.pending, self.states):
+            self.journal.mark(zoomLevel, tileColumn, tileRow, state)
+         self.journal.save()
+      self.written += len(self.pending)
+      self.pending = []
+      self.states = []
+
 class Extract(object):
 
     def __init__(self, extract, top, left, bottom, right,
@@ -414,24 +779,18 @@ def set_up_new_target_db(region):
    put_config()
 
 def to_dir():
-   # write out file tree from mbtiles database
+   # write out file tree from mbtiles database, -z sets the last zoom
    if args.dir != ".":
       prefix = os.path.join(args.dir,'work')
    else:
       prefix = './work'
-   for zoom in range(5):
-      n = numTiles(zoom)
-      for row in range(n):
-         for col in range(n):
-            this_path = os.path.join(prefix,str(zoom),str(col),str(row)+'.jpeg')
-            if not os.path.isdir(os.path.dirname(this_path)):
-               os.makedirs(os.path.dirname(this_path))
-            raw = get_tile(zoom,col,row)
-            with open(this_path,'w') as fp:
-               fp.write(raw)
+   mbTiles.Commit()
+   last = 4 if args.zoom is None else args.zoom
+   export.export(args.mbtiles,prefix,range(0,last+1),workers=args.workers)
 
 def list_tile_sizes():
    bounds = mbTiles.get_bounds()
+   reader = mbTiles.reader()
    for zoom in sorted(bounds):
       if bounds[zoom]['minX'] != 0:
           break
@@ -447,12 +806,12 @@ def list_tile_sizes():
             print('%s   %s   %s'%(i, lower, upper))
             header = False
          for x in range(lower,upper):
-            data = mbTiles.GetTile(i, x, y)
+            data = reader.GetTile(i, x, y)
             tilelen[x] = len(data)
-            if len(data) > threshold:
-               outstr  += 'X'
-            else:
+            if ocean.flat_color(data):
                outstr += 'O'
+            else:
+               outstr  += 'X'
          print(outstr)
          print(str(tilelen))
          
@@ -474,20 +833,37 @@ def debug_one_tile():
    
 def parse_args():
     parser = argparse.ArgumentParser(description="Display mbtile image.")
+    parser.add_argument("--check", help="How closely to check downloaded tiles. (Default=structure)",
+                        choices=verify.LEVELS, default='structure')
     parser.add_argument("-c","--copy", help='Copy -m as src and extend.',action='store_true')
     parser.add_argument("-d","--dir", help='Output to this directory (use "." for ./work/)')
     parser.add_argument("-e", "--extend", help="Get z10-13.",action="store_true")
-    parser.add_argument("-g", "--get", help='get WMTS tiles from this URL(of "." for Sentinel Cloudless).')
+    parser.add_argument("--dedupe", help="Store identical images in -m once.",action="store_true")
+    parser.add_argument("-g", "--get", help='get WMTS tiles from this URL(of "." for Sentinel Cloudless), repeat for mirrors in order of preference.',
+                        action='append')
     parser.add_argument("-i", "--inspect", help="Command line inspection.",action="store_true")
+    parser.add_argument("--index", help="Add the unique indexes to -m, removing duplicates.",action="store_true")
     parser.add_argument("-l", "--list", help="List tile sizes.",action="store_true")
     parser.add_argument("-m", "--mbtiles", help="mbtiles filename.")
     parser.add_argument("-n", "--date", help="mbtiles date component.")
+    parser.add_argument("--mask-zoom", help="Zoom of the land mask, tiles under open ocean there are not fetched, -1 for none. (Default=%s)"%ocean.MASK_ZOOM,
+                        type=int, default=ocean.MASK_ZOOM)
     parser.add_argument("-o", "--onetile", help="Get one tile from source.",action="store_true")
+    parser.add_argument("--overviews", help="Download only -z, build lower zooms from it.",action="store_true")
     parser.add_argument("--lat", help="Latitude degrees.",type=float)
     parser.add_argument("--lon", help="Longitude degrees.",type=float)
     parser.add_argument("-r", "--region", help="Region to operate upon.")
+    parser.add_argument("--race", help="Ask the two best mirrors for each tile at once.",action="store_true")
+    parser.add_argument("--refresh", help="Fetch the tiles of -m again, up to -z, rewriting only those that changed.",
+                        action="store_true")
+    parser.add_argument("--rate", help="Requests per second to the WMTS host.", type=float)
     parser.add_argument("-s", "--summarize", help="Data about each zoom level.",action="store_true")
     parser.add_argument("-t", "--appendmd", help="Append metadata.",action="store_true")
+    parser.add_argument("--timeout", help="Seconds to wait for a tile. (Default=%s)"%httpclient.READ_TIMEOUT,
+                        type=float, default=httpclient.READ_TIMEOUT)
+    parser.add_argument("--retries", help="Tries again after a timeout or a lost connection. (Default=%s)"%httpclient.RETRIES,
+                        type=int, default=httpclient.RETRIES)
+    parser.add_argument("-w", "--workers", help="Concurrent downloads. (Default=%s)"%WORKERS, type=int, default=WORKERS)
     parser.add_argument("-x",  help="tileX", type=int)
     parser.add_argument("-y",  help="tileY", type=int)
     parser.add_argument('-z',"--zoom", help="zoom level. (Default=2)", type=int)
@@ -508,8 +884,8 @@ def get_tile(zoom,tilex,tiley):
       print (err)
    return(data)
 
-def replace_tile(src,zoom,tileX,tileY):
-   global total_tiles
+def replace_tile(src,zoom,tileX,tileY,writer=None):
+   # with a writer the tile is batched, and read verify is skipped
    try:
       r = src.get(zoom,tileX,tileY)
    except Exception as e:
@@ -517,18 +893,17 @@ def replace_tile(src,zoom,tileX,tileY):
       sys.exit(1)
    if r.status == 200:
       raw = r.data
-      line = bytearray(raw)
-      if line.find("DOCTYPE") != -1:
+      result = verify.classify(raw, check_level)
+      if result == 'html':
          print('still getting html from sentinel cloudless')
          return False
+      elif result not in verify.GOOD:
+         print('%s tile from source, zoom:%s X:%s Y:%s'%(result,zoom,tileX,tileY))
+         return False
       else:
-         try:
-            image = Image.open(BytesIO(raw))
-            #image.show(BytesIO(raw))
-         except Exception as e:
-            print('exception:%s'%e)
-            sys.exit()
-         #raw_input("PRESS ENTER")
+         if writer:
+            writer.put(zoom, tileX, tileY, r.data)
+            return True
          mbTiles.SetTile(zoom, tileX, tileY, r.data)
          returned = mbTiles.GetTile(zoom, tileX, tileY)
          if returned != r.data:
@@ -539,8 +914,30 @@ def replace_tile(src,zoom,tileX,tileY):
       print('get url in replace_tile returned:%s'%r.status)
       return False
 
+def set_url():
+   # the -g templates replace Sentinel Cloudless
+   global urls
+   urls = sources.templates(args.get, url)
+
+def get_flat_tiles(mbtiles):
+   # the flat table of the file being written, made once
+   global flat_tiles
+   if flat_tiles is None or flat_tiles.mbtiles is not mbtiles:
+      flat_tiles = ocean.Sparse(mbtiles)
+   return flat_tiles
+
+def get_validators(mbtiles):
+   # the upstream table of the file being written, made once
+   global validators
+   if validators is None or validators.mbtiles is not mbtiles:
+      validators = upstream.Validators(mbtiles)
+   return validators
+
 def get_regions():
+   # read once, by the commands that need a region
    global regions
+   if regions:
+      return regions
    # error out if environment is missing
 
    REGION_INFO = './regions.json'
@@ -551,9 +948,11 @@ def get_regions():
       except:
          print("regions.json parse error")
          sys.exit(1)
+   return regions
    
 def set_metadata(region):
    global extract,dbpath
+   get_regions()
    extract = Extract(dbpath,
         left=regions[region]['west'],
         right=regions[region]['east'],
@@ -563,6 +962,7 @@ def set_metadata(region):
         min_zoom=bbox_zoom_start,
         max_zoom=args.zoom)
    outdict = extract.metadata()
+   outdict['scheme'] = SCHEME
    for key in outdict.keys():
       mbTiles.SetMetaData(key,outdict[key])
       # print(key,outdict[key])
@@ -574,10 +974,12 @@ def view_tiles(stdscr):
    global mbTiles
    global src # the opened url for satellite images
    try:
-      src = WMTS(url)
+      src = sources.Sources(urls, race=args.race)
    except:
       print('failed to open source')
       sys.exit(1)
+   mbTiles.get_bounds()
+   reader = mbTiles.reader()
    if args.zoom:
       zoom = args.zoom
    else:
@@ -596,7 +998,7 @@ def view_tiles(stdscr):
    while 1:
       try:
          if state['source'] == 'tile':
-            raw = mbTiles.GetTile(state['zoom'],state['tileX'],state['tileY'])
+            raw = reader.GetTile(state['zoom'],state['tileX'],state['tileY'])
          else:
             resp = src.get(state['zoom'],state['tileX'],state['tileY'])
             if resp.status == 200:
@@ -640,6 +1042,7 @@ def view_tiles(stdscr):
             state['source'] = 'tile'
       elif ch == ord('p'):
          replace_tile(src,state['zoom'],state['tileX'],state['tileY'])
+         reader.Forget(state['zoom'],state['tileX'],state['tileY'])
       elif ch == ord('='):
          if not state['zoom'] == 14:
             state['tileX'] *= 2
@@ -665,39 +1068,35 @@ def sec2hms(n):
     return '%s days, %s hours, %s minutes %s seconds'%(days,hours,minutes,seconds)
 
 def coordinates2WmtsTilesNumbers(lat_deg, lon_deg, zoom):
-  lat_rad = math.radians(float(lat_deg))
-  n = 2.0 ** zoom
-  xtile = int((float(lon_deg) + 180.0) / 360.0 * n)
-  ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+  x,y = tools.tileXYArray(float(lat_deg),float(lon_deg),zoom)
   # the following would accomodate bottom left origin
   #ytile = int(n - ytile - 1)
-  return (xtile, ytile)
+  return (int(x), int(y))
 
 def bbox_tile_limits(west, south, east, north, zoom):
    #print('west:%s south:%s east:%s north:%s zoom:%s'%(west,south,east,north,zoom))
-   sw = coordinates2WmtsTilesNumbers(south,west,zoom)
-   ne = coordinates2WmtsTilesNumbers(north,east,zoom)
-   x_num = ne[0]+1 - sw[0]
-   y_num = ne[1]+1 - sw[1]
-   #print('ymin:%s ymax:%s'%(sw[1],ne[1]))
-   #print('ne_x:%s x_num:%s ne_y:%s y_num:%s'%(ne[0],x_num,ne[1],y_num))
-   #print('number of tiles of zoom %s:%s = %d seconds at 8/second'%(zoom,y_num*x_num,y_num*x_num/8))
-   #return(xmin,xmax,ymin,ymax)
-   return(sw[0],ne[0]+1, ne[1], sw[1]+1)
+   xmin,xmax,ymin,ymax = tools.bboxTileLimits(west,south,east,north,zoom)
+   return(int(xmin),int(xmax),int(ymin),int(ymax))
+
+def bbox_zoom_limits(box, zooms):
+   # {zoom: (xmin,xmax,ymin,ymax)} for a region, all zooms in one call
+   zooms = list(zooms)
+   limits = tools.bboxTileLimits(box['west'],box['south'],box['east'],box['north'],zooms)
+   return dict([(zoom, tuple([int(a[i]) for a in limits])) for i, zoom in enumerate(zooms)])
 
 def record_bbox_debug_info(region):
-   #cur_box = regions[region]
-   for zoom in range(bbox_zoom_start-1,14):
-      xmin,xmax,ymin,ymax = bbox_tile_limits(cur_box['west'],cur_box['south'],\
-            cur_box['east'],cur_box['north'],zoom)
-      #print(xmin,xmax,ymin,ymax,zoom)
-      tot_tiles = mbTiles.CountTiles(zoom)
-      bbox_limits[zoom] = { 'minX': xmin,'maxX':xmax,'minY':ymin,'maxY':ymax,                              'count':tot_tiles}
+   cur_box = get_regions()[region]
+   mbTiles.Commit()
+   zooms = plan.plan(dbpath, cur_box, range(bbox_zoom_start-1,14))
+   for zoom in zooms:
+      xmin,xmax,ymin,ymax = zooms[zoom]['limits']
+      bbox_limits[zoom] = { 'minX': xmin,'maxX':xmax,'minY':ymin,'maxY':ymax,\
+                            'count':zooms[zoom]['present'],'missing':zooms[zoom]['missing']}
    with open('./work/bbox_limits','w') as fp:
       fp.write(json.dumps(bbox_limits,indent=2))
 
-def put_accumulators(zoom,ocean=0,land=0,count=0,done='False'):
-   mbTiles.SetSatMetaData(zoom,'ocean',str(ocean))
+def put_accumulators(zoom,flat=0,land=0,count=0,done='False'):
+   mbTiles.SetSatMetaData(zoom,'ocean',str(flat))
    mbTiles.SetSatMetaData(zoom,'land',str(land))
    mbTiles.SetSatMetaData(zoom,'count',str(count))
    mbTiles.SetSatMetaData(zoom,'done',str(done))
@@ -716,19 +1115,82 @@ def get_accumulators(zoom):
 
 def fetch_quad_for(tileX, tileY, zoom):
    # get 4 tiles for zoom+1
-   lock = Lock()
-   p1 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2,tileY*2,lock))
-   p1.start()
-   p2 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2+1,tileY*2,lock))
-   p2.start()
-   p3 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2,tileY*2+1,lock))
-   p3.start()
-   p4 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2+1,tileY*2+1,lock))
-   p4.start()
-   p1.join()
-   p2.join()
-   p3.join()
-   p4.join()
+   quad = [(zoom+1,tileX*2,tileY*2),(zoom+1,tileX*2+1,tileY*2),\
+           (zoom+1,tileX*2,tileY*2+1),(zoom+1,tileX*2+1,tileY*2+1)]
+   jobs = [tile for tile in quad if not mbTiles.TileExists(*tile)]
+   counts = { 'present': 0, 'ocean': 0, 'land': 0, 'failed': 0 }
+   with mbTiles.writer() as writer:
+      TileFetcher(src,workers=4,inspect=water_color).run(jobs,partial(store_tile,writer,counts))
+
+def missing_tiles(journal, zoom, counts, writer=None, mask=None):
+   # yields the tiles of this zoom that the journal has not seen done or empty,
+   #   those the land mask says are ocean are written, without being fetched
+   journal.seed(zoom)
+   counts['present'] = journal.count(zoom,'done')
+   counts['ocean'] = journal.count(zoom,'empty')
+   print('Resuming zoom %s, tiles already present:%s ocean:%s failed before:%s'%(zoom,\
+         counts['present'],counts['ocean'],journal.count(zoom,'failed')))
+   for (xtile, ytile) in journal.pending(zoom):
+      color = mask.ocean(zoom, xtile, ytile) if mask else None
+      if color:
+         writer.put(zoom, xtile, ytile, ocean.shared_tile(color), 'empty')
+         counts['ocean'] += 1
+         continue
+      yield (zoom, xtile, ytile)
+
+def tile_failed(writer, counts, zoom, xtile, ytile):
+   # the run goes on, --fix and the next resume fetch it again
+   counts['failed'] = counts.get('failed', 0) + 1
+   if writer.journal:
+      writer.journal.mark(zoom, xtile, ytile, 'failed')
+
+def water_color(r):
+   # the TileFetcher inspect, run in its worker threads so that the tiles are
+   #   not decoded by the one writer. The colour of a flat water tile, None
+   #   for any other, cloud, snow and night tiles are flat and kept as they are.
+   if r.status != 200:
+      return None
+   color = ocean.flat_color(r.data)
+   if color and ocean.is_water(color):
+      return color
+   return None
+
+def store_tile(writer, counts, zoom, xtile, ytile, r, error, color=None):
+   # called by TileFetcher, in the main thread, for every fetched tile, color
+   #   is its water_color
+   if error:
+      tile_failed(writer, counts, zoom, xtile, ytile)
+      print('%s zoom:%s X:%s Y:%s'%(error,zoom,xtile,ytile))
+      return
+   if r.status == 200:
+      raw = r.data
+      result = verify.classify(raw, check_level)
+      if result == 'html':
+         tile_failed(writer, counts, zoom, xtile, ytile)
+         print('still getting html from sentinel cloudless')
+         return
+      if result not in verify.GOOD:
+         # kept in the journal as failed, and fetched again on the next run
+         tile_failed(writer, counts, zoom, xtile, ytile)
+         print('%s tile from source, zoom:%s X:%s Y:%s'%(result,zoom,xtile,ytile))
+         return
+      # a tile of open water is stored as the image shared by its colour
+      try:
+         get_validators(writer.mbtiles).add(zoom, xtile, ytile, r)
+         if color:
+            writer.put(zoom, xtile, ytile, ocean.shared_tile(color, verify.image_format(raw)), 'empty')
+            get_flat_tiles(writer.mbtiles).add(zoom, xtile, ytile, color)
+         else:
+            writer.put(zoom, xtile, ytile, raw)
+      except Exception as e:
+         print('exception:%s'%e)
+         sys.exit()
+      counts['ocean' if color else 'land'] += 1
+      if (counts['ocean'] + counts['land']) % 50 == 0:
+          print('+',flush=True,end="")
+   else:
+      tile_failed(writer, counts, zoom, xtile, ytile)
+      print('status returned:%s X:%s  Y:%s'%(r.status,xtile,ytile))
 
 
 def is_done(zoom):
@@ -752,33 +1214,25 @@ def download_region(region):
    stdscr.addstr(1,10,'PRESENT')
    stdscr.addstr(1,20,'NEEDED')
    stdscr.addstr(1,30,'PERCENT')
+   stdscr.addstr(1,40,'BYTES')
    stdscr.addstr(1,50,"DAYS")
 
-   # 
-   cur_box = regions[region]
+   # exact counts of what is missing in the bbox, at the measured rate
+   cur_box = get_regions()[region]
+   zooms = plan.plan(dbpath, cur_box, range(14))
    for zoom in range(14):
       stdscr.addstr(zoom+2,0,str(zoom))
-      xmin,xmax,ymin,ymax = bbox_tile_limits(cur_box['west'],cur_box['south'],\
-            cur_box['east'],cur_box['north'],zoom)
-      #print(xmin,xmax,ymin,ymax,zoom)
+      xmin,xmax,ymin,ymax = zooms[zoom]['limits']
       bbox_limits[zoom] = { 'minX': xmin,'maxX':xmax,'minY':ymin,'maxY':ymax}
-
-      if bounds.get(zoom,-1) == -1: continue
-      tiles = (bounds[zoom]['maxX']-bounds[zoom]['minX'])*\
-              (bounds[zoom]['maxY']-bounds[zoom]['minY'])
-      stdscr.addstr(zoom+2,10,str(tiles))
-      
-   for zoom in range(bbox_zoom_start,13):
-      stdscr.addstr(zoom+2,0,str(zoom))
-      tiles = (xmax-xmin)*(ymax-ymin)
-      stdscr.addstr(zoom+2,20,str(tiles))
-      hours = tiles/3600/24.0
-      stdscr.addstr(zoom+2,50,'%0.2f'%hours)
-      if processed % 10 == 0:
-               stdscr.addstr(zoom+2,10,"%d"%processed)
-               stdscr.refresh()
-
-      stdscr.refresh()
+      present = zooms[zoom]['present']
+      missing = zooms[zoom]['missing']
+      stdscr.addstr(zoom+2,10,str(present))
+      stdscr.addstr(zoom+2,20,str(missing))
+      if present + missing:
+         stdscr.addstr(zoom+2,30,'%0.1f'%(100.0 * present / (present + missing)))
+      stdscr.addstr(zoom+2,40,plan.human_bytes(zooms[zoom]['bytes']))
+      stdscr.addstr(zoom+2,50,'%0.2f'%(zooms[zoom]['seconds']/3600/24.0))
+   stdscr.refresh()
 
 def test(region):
 
@@ -791,87 +1245,105 @@ def append_metadata():
    
 def download_world(region='world'):
    #record_bbox_debug_info(args.region)
-   ocean, land, startx, starty, count, done = get_accumulators(bbox_zoom_start)
 
    # Open a WMTS source
    global src # the opened url for satellite images
    try:
-      src = WMTS(url)
+      src = sources.Sources(urls,maxsize=args.workers,rate=args.rate,race=args.race)
    except:
       print('failed to open source')
       sys.exit(1)
-   # Skip over the tiles we alrady have 
-   start = start_pd = time.time()
-   for zoom in range(bbox_zoom_start,args.zoom+1):
+   fetcher = TileFetcher(src,workers=args.workers,inspect=water_color)
+   journal = Journal(mbTiles)
+   mbTiles.SetMetaData('scheme',SCHEME)
+   mask = None
+   start = time.time()
+   # with --overviews only the deepest zoom is downloaded, the rest are built from it
+   first_zoom = bbox_zoom_start
+   if args.overviews:
+      first_zoom = args.zoom
+   for zoom in range(first_zoom,args.zoom+1):
       print("new zoom level:%s"%zoom)
-      maxY = maxX = numTiles(args.zoom)
-
-      ocean, land, startx, starty, count, done = get_accumulators(zoom)
+      flat, land, startx, starty, count, done = get_accumulators(zoom)
+      counts = { 'present': 0, 'ocean': flat, 'land': land, 'failed': 0 }
+      if mask is None and args.mask_zoom >= 0 and zoom > args.mask_zoom:
+         mask = ocean.LandMask(get_flat_tiles(mbTiles), args.mask_zoom)
       start_pd = time.time()
+      fetched = fetcher.fetched
 
-      for ytile in range(bbox_zoom_start+1,maxY+1):
-         mbTiles.SetSatMetaData(zoom,'tileY',str(ytile))
-         land_pd = land
-         ocean_pd = ocean
-         for xtile in range(bbox_zoom_start+1,maxX+1):
-            if not mbTiles.TileExists(zoom,xtile,ytile):
-               try:
-                  r = src.get(zoom,xtile,ytile)
-               except Exception as e:
-                  print(str(e))
-                  sys.exit(1)
-               if r.status == 200:
-                  raw = r.data
-                  line = bytes(raw)
-                  if line.find(b"DOCTYPE") != -1:
-                     print('still getting html from sentinel cloudless')
-                     continue
-                  else:
-                     try:
-                        image = Image.open(BytesIO(raw))
-                        #image.show(BytesIO(raw))
-                     except Exception as e:
-                        print('exception:%s'%e)
-                        sys.exit()
-                     #raw_input("PRESS ENTER")
-                     try:
-                        mbTiles.SetTile(zoom, xtile, ytile, r.data)
-                     except Exception as e:
-                        print('exception:%s'%e)
-                        sys.exit()
-                     land += 1
-                     if land % 50 == 0:
-                         print('+',flush=True,end="")
-                     '''
-                     returned = mbTiles.GetTile(zoom, tileX, tileY)
-                     if bytearray(returned) != r.data:
-                        print('read verify in replace_tile failed')
-                        return False
-                     return True
-                     '''
-               else:
-                   print('status returned:%s X:%s  Y:%s'%(r.status,xtile,ytile))
-            else:
-                ocean += 1
-                if ocean % 50 == 0:
-                   print('.',flush=True,end="")
-      print("ytile row completed:%s."%ytile)
-      print('Total time:%s Total_tiles:%s'%(time.time()-start,land))
+      # Skip over the tiles we already have, and those under open ocean
+      with mbTiles.writer(journal=journal) as writer:
+         fetcher.run(missing_tiles(journal,zoom,counts,writer,mask),partial(store_tile,writer,counts))
+      print('\nTotal time:%s Total_tiles:%s ocean:%s failed:%s'%(time.time()-start,counts['land'],\
+            counts['ocean'],counts['failed']))
       # Print a summary of rate and activitys
-      mbTiles.SetSatMetaData(zoom,'xtile',str(xtile))
-      rate = (land - land_pd) / (time.time() - start_pd)
-      start_pd = time.time()
-      land_pd = land
-      print('\nRate:%s Tiles::%s'%(rate,land,))
-         
-   print('zoom %s completed'%zoom)
-   done = True
-   put_accumulators(zoom,ocean,land,count,done)
-   ocean, land, startx, starty, count, done = get_accumulators(zoom)
-   print('Total time:%s Total_tiles:%s'%(time.time()-start,land))
+      # requests per second, what plan.py estimates with
+      rate = (fetcher.fetched - fetched) / (time.time() - start_pd)
+      print('Rate:%s Tiles::%s'%(rate,counts['land'],))
+      if fetcher.fetched > fetched:
+         mbTiles.SetSatMetaData(zoom,'rate','%0.2f'%rate)
+      print('zoom %s completed'%zoom)
+      put_accumulators(zoom,counts['ocean'],counts['land'],count,True)
+
+   print('Total time:%s Total_tiles:%s Throttled:%s'%(time.time()-start,fetcher.fetched,\
+         src.throttled()))
+   src.report()
+   print(httpclient.shared().summary())
+   httpclient.shared().save_stats()
+   if args.overviews and args.zoom > bbox_zoom_start:
+      pyramid.build(mbTiles,args.zoom,bbox_zoom_start)
    #mbTiles.delete_zoom(bbox_zoom_start-1)
    set_metadata(region)
 
+def refresh_tile(writer, counts, zoom, xtile, ytile, r, error, color=None):
+   # called by TileFetcher for every tile asked for again, color is its
+   #   water_color
+   # a tile with no upstream hash, fetched before it was kept, is rewritten
+   known = get_validators(writer.mbtiles).hashes.pop((zoom, xtile, ytile), None)
+   if not error and r.status == 304:
+      get_validators(writer.mbtiles).add(zoom, xtile, ytile, r)
+      counts['same'] += 1
+   elif not error and r.status == 200 and verify.classify(r.data, check_level) in verify.GOOD:
+      if known and tile_hash(r.data) == known:
+         get_validators(writer.mbtiles).add(zoom, xtile, ytile, r)
+         counts['same'] += 1
+      else:
+         store_tile(writer, counts, zoom, xtile, ytile, r, None, color)
+         counts['changed'] += 1
+   else:
+      # left unchecked, and asked for again by the next refresh
+      counts['failed'] += 1
+   checked = counts['same'] + counts['changed'] + counts['failed']
+   if checked % BATCH_SIZE == 0:
+      # the tiles, then the validators and checks of the batch
+      writer.flush()
+      writer.mbtiles.Commit()
+      print('checked:%s changed:%s failed:%s'%(checked,counts['changed'],counts['failed']))
+
+def refresh_world():
+   # asks again for every tile of -m, up to -z, with the validators the
+   #   source gave last time, and rewrites only the tiles that changed
+   global src # the opened url for satellite images
+   src = sources.Sources(urls,maxsize=args.workers,rate=args.rate,race=args.race)
+   fetcher = TileFetcher(src,workers=args.workers,inspect=water_color)
+   checks = get_validators(mbTiles)
+   for zoom in sorted(mbTiles.get_bounds()):
+      if args.zoom is not None and zoom > args.zoom:
+         break
+      start = time.time()
+      counts = { 'same': 0, 'changed': 0, 'failed': 0, 'ocean': 0, 'land': 0 }
+      since = checks.started(zoom)
+      with mbTiles.writer() as writer:
+         fetcher.run(checks.unchecked(zoom, since),partial(refresh_tile,writer,counts))
+      mbTiles.Commit()
+      if counts['failed'] == 0:
+         checks.finished(zoom)
+      print('zoom %s refreshed in %0.1f seconds, unchanged:%s changed:%s failed:%s'%(zoom,\
+            time.time()-start,counts['same'],counts['changed'],counts['failed']))
+   src.report()
+   print(httpclient.shared().summary())
+   httpclient.shared().save_stats()
+
 def make_sat_extension(region):
    set_up_new_target_db(region)
    download_world(region)
@@ -909,27 +1381,34 @@ def download(scr):
 def main():
    global args
    global mbTiles
+   global check_level
    if not os.path.isdir('./work'):
       os.mkdir('./work')
    get_config()
    args = parse_args()
-   get_regions() # read the json region into global dictionary
+   check_level = args.check
+   httpclient.configure(maxsize=args.workers, read=args.timeout, retries=args.retries)
+   # regions, bounds and the WMTS source are loaded by the commands that use them
 
    if not args.mbtiles: #remember current project in/out setup
       if config.get('last_src','') != '':
          args.mbtiles = config['last_src']
       else:  # fall back to symbolic link
          args.mbtiles = '%s/satellite.mbtiles'%os.getcwd()
-   print(args.mbtiles)
-   mbTiles  = MBTiles(args.mbtiles)
-   bounds = mbTiles.get_bounds()
    print('SOURCE mbtiles filename:%s'%args.mbtiles)
+   if args.onetile:
+      debug_one_tile()
+      sys.exit(0)
+   mbTiles  = MBTiles(args.mbtiles)
 
    if args.summarize:
       mbTiles.summarize()
       sys.exit(0)
-   if args.onetile:
-      debug_one_tile()
+   if args.index:
+      mbTiles.CheckSchema()
+      sys.exit(0)
+   if args.dedupe:
+      mbTiles.Dedupe()
       sys.exit(0)
    if args.list:
       list_tile_sizes()
@@ -945,6 +1424,9 @@ def main():
    if args.dir != None:
       to_dir()
       sys.exit(0)
+   if args.refresh:
+      refresh_world()
+      sys.exit(0)
    if args.region == None:
       args.region = 'world'
    if args.date == None:
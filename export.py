@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Write the tiles of an mbtiles out as a zoom/column/row directory tree
+
+# Only tiles that exist are read, all through one cursor in map_index order,
+#   so each column's directory is made once, before its first tile. Files are
+#   written by a pool of threads, with a bounded number waiting.
+# Options:
+#   zoom range and bbox      -- only those tiles are read
+#   link                     -- images shared by several tiles are written
+#                               once, the other paths are hard links to it
+#   incremental              -- files already there with the right size are
+#                               left alone
+# Rows are written as stored, --tms flips them.
+
+import os, sys
+import argparse
+import sqlite3
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import tools
+import verify
+
+WORKERS = 8
+EXTENSIONS = { 'jpeg': 'jpeg', 'png': 'png', 'webp': 'webp', 'pbf': 'pbf' }
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Write mbtiles tiles into a directory tree.")
+   parser.add_argument("mbtiles", help="mbtiles filename.")
+   parser.add_argument("output", help="Directory to write zoom/column/row files under.")
+   parser.add_argument("--min", help="First zoom. (Default=0)", type=int, default=0)
+   parser.add_argument("-z", "--zoom", help="Last zoom. (Default=every zoom)", type=int)
+   parser.add_argument("-b", "--bbox", help="Only tiles within west,south,east,north.")
+   parser.add_argument("-w", "--workers", help="Writing threads. (Default=%s)"%WORKERS, type=int, default=WORKERS)
+   parser.add_argument("-l", "--link", help="Hard link tiles that share an image.", action='store_true')
+   parser.add_argument("-i", "--incremental", help="Skip files already present with the same size.",
+                       action='store_true')
+   parser.add_argument("--tms", help="Flip rows between tms and xyz.", action='store_true')
+   return parser.parse_args()
+
+def write_tile(path, data, incremental):
+   # runs in a worker thread, returns 'written' or 'skipped'
+   if incremental and os.path.exists(path) and os.path.getsize(path) == len(data):
+      return 'skipped'
+   with open(path, 'wb') as tile_fp:
+      tile_fp.write(data)
+   return 'written'
+
+def link_tile(first, path, data, incremental):
+   # first is the future of the write of the same image to another path
+   source = first.result()[1]
+   if incremental and os.path.exists(path) and os.path.getsize(path) == len(data):
+      return 'skipped'
+   try:
+      if os.path.exists(path):
+         os.remove(path)
+      os.link(source, path)
+      return 'linked'
+   except OSError:
+      return write_tile(path, data, False)
+
+def first_write(path, data, incremental):
+   return (write_tile(path, data, incremental), path)
+
+def export_tiles(conn, zooms, bbox=None):
+   # yields (zoom, column, row, tile_id, tile_data) in map_index order
+   sql = '''SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_id, images.tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id WHERE map.zoom_level = ?'''
+   if bbox:
+      limits = tools.bboxTileLimits(bbox[0], bbox[1], bbox[2], bbox[3], list(zooms))
+   for i, zoom in enumerate(zooms):
+      if bbox:
+         (x0, x1, y0, y1) = [int(a[i]) for a in limits]
+         rows = conn.execute(sql + ''' AND map.tile_column >= ? AND map.tile_column < ?
+               AND map.tile_row >= ? AND map.tile_row < ? ORDER BY map.tile_column, map.tile_row''',
+               (zoom, x0, x1, y0, y1))
+      else:
+         rows = conn.execute(sql + ' ORDER BY map.tile_column, map.tile_row', (zoom,))
+      for row in rows:
+         yield row
+
+def export(path, output, zooms, bbox=None, workers=WORKERS, link=False, incremental=False, tms=False):
+   conn = sqlite3.connect('file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(path)), uri=True)
+   zooms = list(zooms)
+   shared = set()
+   if link:
+      sql = 'SELECT tile_id FROM map GROUP BY tile_id HAVING count(*) > 1'
+      shared = set([row[0] for row in conn.execute(sql)])
+   firsts = {} # tile_id -> future of its first write
+   counts = { 'written': 0, 'linked': 0, 'skipped': 0 }
+   start = time.time()
+   column = None
+   pending = set()
+
+   def drain(pending):
+      finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in finished:
+         result = future.result()
+         if isinstance(result, tuple):
+            result = result[0]
+         counts[result] += 1
+      return pending
+
+   with ThreadPoolExecutor(max_workers=workers) as pool:
+      for (zoom, tileX, tileY, tile_id, data) in export_tiles(conn, zooms, bbox):
+         if tms:
+            tileY = (1 << zoom) - tileY - 1
+         if (zoom, tileX) != column:
+            column = (zoom, tileX)
+            directory = os.path.join(output, str(zoom), str(tileX))
+            os.makedirs(directory, exist_ok=True)
+         data = bytes(data)
+         tile_path = os.path.join(directory, '%s.%s'%(tileY, EXTENSIONS.get(verify.image_format(data), 'jpeg')))
+         if tile_id in firsts:
+            pending.add(pool.submit(link_tile, firsts[tile_id], tile_path, data, incremental))
+         elif tile_id in shared:
+            firsts[tile_id] = pool.submit(first_write, tile_path, data, incremental)
+            pending.add(firsts[tile_id])
+         else:
+            pending.add(pool.submit(write_tile, tile_path, data, incremental))
+         while len(pending) >= workers * 4:
+            pending = drain(pending)
+      while len(pending) > 0:
+         pending = drain(pending)
+   conn.close()
+   print('Exported to %s, written:%s linked:%s skipped:%s in %0.1f seconds'%(output,\
+         counts['written'],counts['linked'],counts['skipped'],time.time()-start))
+   return counts
+
+def zoom_range(path, first, last=None):
+   # the zooms to export, up to the deepest one in the file if last is None
+   if last is None:
+      conn = sqlite3.connect('file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(path)), uri=True)
+      last = conn.execute('SELECT max(zoom_level) FROM map').fetchone()[0] or 0
+      conn.close()
+   return range(first, last + 1)
+
+def main():
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('Failed to open %s -- Quitting'%args.mbtiles)
+      sys.exit(1)
+   bbox = None
+   if args.bbox:
+      bbox = [float(v) for v in args.bbox.split(',')]
+   export(args.mbtiles, args.output, zoom_range(args.mbtiles, args.min, args.zoom), bbox,
+          args.workers, args.link, args.incremental, args.tms)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Fetch WMTS tiles concurrently, completed tiles are handed to a single writer
+
+# The source (wmts.WMTS) is shared by all the worker threads, its client
+#   (httpclient.shared()) is thread safe, so connections are reused across workers.
+# Results are drained in the thread that called run(), so the done()
+#   callback can write to sqlite without any locking. Work on a response that
+#   needs no sqlite, such as decoding it, is given as "inspect" and done in
+#   the worker threads, its result is passed on to done().
+# At most "backlog" requests are in flight or waiting to be drained. When that
+#   is reached run() stops reading jobs until a result has been written.
+# Requests to each host are paced by a HostLimiter, shared by every source
+#   that uses the host (see host_limiter()).
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
+
+WORKERS = 8
+# seconds to wait after throttling when the window is already at its minimum
+BACKOFF = 1.0
+# one HostLimiter per host name
+limiters = {}
+limiters_lock = threading.Lock()
+
+def is_throttled(response):
+   # 429, server errors, and html error pages in place of a tile
+   if response.status == 429 or response.status >= 500:
+      return True
+   return bytes(response.data[:512]).find(b"DOCTYPE") != -1
+
+def retry_after(response):
+   try:
+      return float(response.headers.get('Retry-After'))
+   except (TypeError, ValueError):
+      return None
+
+def host_limiter(host, rate=None, concurrency=WORKERS):
+   # the first caller for a host sets its window, a later rate replaces the old
+   with limiters_lock:
+      if host not in limiters:
+         limiters[host] = HostLimiter(rate, concurrency)
+      elif rate:
+         limiters[host].set_rate(rate)
+      return limiters[host]
+
+class HostLimiter(object):
+   # A token bucket keeps requests under "rate" per second (None is no limit).
+   # An AIMD window limits the requests in flight. It grows by one after a
+   #   window's worth of clean responses, and is halved on throttling.
+#   Connection errors and timeouts leave it as it is, failover handles those.
+
+   def __init__(self, rate=None, concurrency=WORKERS):
+      self.rate = rate
+      self.capacity = max(1.0, rate or 1.0)
+      self.tokens = self.capacity
+      self.stamp = time.monotonic()
+      self.maximum = concurrency
+      self.window = float(concurrency)
+      self.in_flight = 0
+      self.resume_at = 0.0
+      self.last_decrease = 0.0
+      self.throttled = 0
+      self.cond = threading.Condition()
+
+   def set_rate(self, rate):
+      with self.cond:
+         self.rate = rate
+         self.capacity = max(1.0, rate)
+         self.tokens = min(self.tokens, self.capacity)
+
+   def acquire(self):
+      with self.cond:
+         while self.in_flight >= int(self.window):
+            self.cond.wait()
+         self.in_flight += 1
+         while True:
+            now = time.monotonic()
+            if now < self.resume_at:
+               delay = self.resume_at - now
+            elif self.rate:
+               self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+               self.stamp = now
+               if self.tokens >= 1.0:
+                  self.tokens -= 1.0
+                  return
+               delay = (1.0 - self.tokens) / self.rate
+            else:
+               return
+            self.cond.wait(delay)
+
+   def release(self, throttled=False, pause=None, failed=False):
+      # failed is a request with no response, it says nothing of the host's load
+      with self.cond:
+         self.in_flight -= 1
+         now = time.monotonic()
+         if failed:
+            pass
+         elif throttled:
+            self.throttled += 1
+            # one decrease per round trip, not one per response in flight
+            if now - self.last_decrease > 1.0:
+               self.last_decrease = now
+               if int(self.window) <= 1 and not pause:
+                  pause = BACKOFF
+               self.window = max(1.0, self.window / 2)
+            if pause:
+               self.resume_at = max(self.resume_at, now + pause)
+         else:
+            self.window = min(self.maximum, self.window + 1.0 / self.window)
+         self.cond.notify_all()
+
+class TileFetcher(object):
+
+   def __init__(self, src, workers=WORKERS, backlog=None, inspect=None):
+      self.src = src
+      self.inspect = inspect
+      self.workers = workers
+      if backlog:
+         self.backlog = backlog
+      else:
+         self.backlog = workers * 2
+      self.fetched = 0
+      self.failed = 0
+
+   def fetch(self, zoom, tileX, tileY, headers=None):
+      # runs in a worker thread
+      try:
+         if headers:
+            response = self.src.get(zoom, tileX, tileY, headers)
+         else:
+            response = self.src.get(zoom, tileX, tileY)
+      except Exception as e:
+         return (zoom, tileX, tileY, None, e, None)
+      if self.inspect:
+         return (zoom, tileX, tileY, response, None, self.inspect(response))
+      return (zoom, tileX, tileY, response, None, None)
+
+   def drain(self, pending, done):
+      finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in finished:
+         (zoom, tileX, tileY, response, error, found) = future.result()
+         if error:
+            self.failed += 1
+         else:
+            self.fetched += 1
+         if self.inspect:
+            done(zoom, tileX, tileY, response, error, found)
+         else:
+            done(zoom, tileX, tileY, response, error)
+      return pending
+
+   def run(self, jobs, done):
+      # jobs yields (zoom, tileX, tileY), or (zoom, tileX, tileY, headers) for
+      #   the request, and is read lazily
+      # done(zoom, tileX, tileY, response, error) is called for every job,
+      #   with inspect(response) after them if the fetcher has an inspect
+      pending = set()
+      with ThreadPoolExecutor(max_workers=self.workers) as pool:
+         for job in jobs:
+            pending.add(pool.submit(self.fetch, *job))
+            while len(pending) >= self.backlog:
+               pending = self.drain(pending, done)
+         while len(pending) > 0:
+            pending = self.drain(pending, done)
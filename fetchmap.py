@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# Download a map catalog mbtiles in parallel byte ranges, resuming, and check its md5
+
+# The file is cut into CHUNKs, fetched by -s threads at once with Range
+#   requests through the shared http client, and written straight to their
+#   place in NAME.part, allocated at full size up front.
+# Finished chunks are a journal.RangeSet of chunk numbers, saved with the
+#   url, size and ETag in NAME.part.json every few seconds, after an fsync.
+#   A run that is stopped starts again from there. If-Range makes a server
+#   whose file has changed send all of it, and the download starts over.
+# A server that ignores ranges is read in one stream, and cannot resume.
+# The md5 is, in order: --md5, the catalog entry's 'md5', or the sidecar
+#   URL.md5 as checksum.py writes them (md5sum output). The finished file is
+#   renamed from .part, and its hashes go into checksum's cache and sidecars.
+#   With no md5 anywhere the file is kept, unchecked.
+# NAME is a key of "maps" or "base" in the catalog (a file or a url), the
+#   file name of one of their urls, a url, or "planet" or "satellite" for the
+#   base files.
+
+import os, sys
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpclient
+import checksum
+from journal import RangeSet
+
+CATALOG = './map-catalog.json'
+SEGMENTS = 8
+CHUNK = 8 * 1024 * 1024
+# bytes read from the socket at a time
+BLOCK = 256 * 1024
+# tries of one chunk before giving up
+ATTEMPTS = 5
+# seconds between saves of the progress
+SAVE_EVERY = 5.0
+# the base files every region needs, as in check_catalog.py
+BASES = { 'planet': 'https://archive.org/download/osm-planet_z0-z10_2019.mbtiles/osm-planet_z0-z10_2019.mbtiles',
+          'satellite': 'https://archive.org/download/satellite_z0-z9_v3.mbtiles/satellite_z0-z9_v3.mbtiles' }
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Download an mbtiles of the map catalog.")
+   parser.add_argument("name", nargs='?', help="Catalog name, file name, url, planet or satellite.")
+   parser.add_argument("-c", "--catalog", help="map-catalog.json, a file or url. (Default=%s)"%CATALOG,
+                       default=CATALOG)
+   parser.add_argument("-o", "--output", help="Directory to download into. (Default=.)", default='.')
+   parser.add_argument("-s", "--segments", help="Ranges fetched at once. (Default=%s)"%SEGMENTS, type=int,
+                       default=SEGMENTS)
+   parser.add_argument("-u", "--url", help="Catalog url to use. (Default=detail_url)", default='detail_url',
+                       choices=('detail_url','archive_url'))
+   parser.add_argument("--md5", help="Expected md5, instead of the catalog's or the sidecar's.")
+   parser.add_argument("-l", "--list", help="List the catalog, with sizes.", action='store_true')
+   return parser.parse_args()
+
+def load_catalog(catalog):
+   if catalog.startswith('http'):
+      r = httpclient.shared().request("GET",catalog)
+      if r.status >= 400:
+         print('Failed to open %s Status:%s'%(catalog,r.status))
+         sys.exit(1)
+      return json.loads(r.data)
+   with open(catalog,'r') as catalog_fp:
+      return json.loads(catalog_fp.read())
+
+def find_entry(data, name, key='detail_url'):
+   # the catalog entry for a name, or None
+   for group in ('maps','base'):
+      entries = data.get(group,{})
+      if name in entries:
+         return entries[name]
+      for entry in entries.values():
+         if os.path.basename(entry.get(key,'')) == name:
+            return entry
+   return None
+
+def remote_md5(url):
+   # from the sidecar next to the file, None if there is none
+   try:
+      r = httpclient.shared().request("GET",url + '.md5')
+   except Exception:
+      return None
+   if r.status != 200:
+      return None
+   words = r.data.decode('utf-8','replace').split()
+   return words[0] if words else None
+
+def probe(url):
+   # (size, ranges, etag), from a HEAD
+   r = httpclient.shared().request("HEAD",url)
+   if r.status >= 400:
+      print('Failed to open %s Status:%s'%(url,r.status))
+      sys.exit(1)
+   size = int(r.headers.get('Content-Length',0))
+   ranges = r.headers.get('Accept-Ranges','none').lower() == 'bytes' and size > 0
+   return (size, ranges, r.headers.get('ETag') or r.headers.get('Last-Modified'))
+
+def load_state(path, url, size, etag):
+   # the chunks already done, none if the file has changed
+   try:
+      with open(path,'r') as state_fp:
+         state = json.loads(state_fp.read())
+   except (OSError, ValueError):
+      return RangeSet()
+   if (state.get('url'), state.get('size'), state.get('etag'), state.get('chunk')) != (url, size, etag, CHUNK):
+      print('%s has changed since the last try, starting again'%url)
+      return RangeSet()
+   return RangeSet(state['done'])
+
+def save_state(path, url, size, etag, done):
+   with open(path + '.tmp','w') as state_fp:
+      state_fp.write(json.dumps({ 'url': url, 'size': size, 'etag': etag, 'chunk': CHUNK, 'done': done.ranges() }))
+   os.replace(path + '.tmp', path)
+
+class Restart(Exception):
+   pass
+
+def fetch_chunk(url, fd, index, size, etag):
+   # runs in a worker thread, writes chunk "index" to its place in fd
+   start = index * CHUNK
+   end = min(size, start + CHUNK) - 1
+   headers = { 'Range': 'bytes=%s-%s'%(start, end) }
+   if etag:
+      headers['If-Range'] = etag
+   r = httpclient.shared().request("GET",url,headers=headers,preload_content=False)
+   try:
+      if r.status == 200:
+         raise Restart('%s has changed, or ignores ranges'%url)
+      if r.status != 206 or not r.headers.get('Content-Range','').startswith('bytes %s-'%start):
+         raise IOError('status %s for bytes %s-%s'%(r.status,start,end))
+      offset = start
+      for block in r.stream(BLOCK):
+         os.pwrite(fd, block, offset)
+         offset += len(block)
+      if offset != end + 1:
+         raise IOError('short read, bytes %s-%s ended at %s'%(start,end,offset))
+   finally:
+      r.release_conn()
+   return index
+
+def fetch_whole(url, path):
+   # for a server without ranges, one stream from the start
+   r = httpclient.shared().request("GET",url,preload_content=False)
+   try:
+      if r.status != 200:
+         raise IOError('status %s for %s'%(r.status,url))
+      with open(path,'wb') as part_fp:
+         for block in r.stream(BLOCK):
+            part_fp.write(block)
+   finally:
+      r.release_conn()
+
+def fetch_ranges(url, part, size, etag, segments):
+   # returns True when every chunk is in part
+   state = part + '.json'
+   done = load_state(state, url, size, etag)
+   chunks = (size + CHUNK - 1) // CHUNK
+   todo = [index for index in range(chunks) if index not in done]
+   fd = os.open(part, os.O_RDWR | os.O_CREAT)
+   try:
+      if os.fstat(fd).st_size != size:
+         if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+         else:
+            os.ftruncate(fd, size)
+      print('%s: %s of %s chunks to fetch'%(os.path.basename(url),len(todo),chunks))
+      httpclient.shared(segments)
+      tries = {}
+      pending = {} # future -> chunk
+      start = time.time()
+      saved = start
+      fetched = 0
+      with ThreadPoolExecutor(max_workers=segments) as pool:
+         while todo or pending:
+            while todo and len(pending) < segments:
+               index = todo.pop(0)
+               pending[pool.submit(fetch_chunk, url, fd, index, size, etag)] = index
+            finished, waiting = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in finished:
+               index = pending.pop(future)
+               try:
+                  future.result()
+               except Restart as e:
+                  # what was written may be from the old file
+                  print(str(e))
+                  todo = []
+                  done = RangeSet()
+                  continue
+               except Exception as e:
+                  tries[index] = tries.get(index, 0) + 1
+                  print('bytes %s-: %s, try %s of %s'%(index * CHUNK,e,tries[index],ATTEMPTS))
+                  if tries[index] < ATTEMPTS:
+                     todo.append(index)
+                  continue
+               done.add(index)
+               fetched += min(size, (index + 1) * CHUNK) - index * CHUNK
+            if time.time() - saved > SAVE_EVERY:
+               os.fsync(fd)
+               save_state(state, url, size, etag, done)
+               saved = time.time()
+               print('%0.1f%% %0.1f MB/s'%(100.0 * len(done) / chunks,fetched / (saved - start) / 1e6))
+      os.fsync(fd)
+      save_state(state, url, size, etag, done)
+      if fetched:
+         print('%s MB in %0.1f seconds, %0.1f MB/s'%(fetched // 1000000,time.time() - start,\
+               fetched / max(time.time() - start, 0.001) / 1e6))
+   finally:
+      os.close(fd)
+   return len(done) == chunks
+
+def download(url, output, segments=SEGMENTS, md5=None):
+   # the path of the checked file, None if it is not all there or is not right
+   path = os.path.join(output, os.path.basename(url))
+   part = path + '.part'
+   (size, ranges, etag) = probe(url)
+   if ranges:
+      if not fetch_ranges(url, part, size, etag, segments):
+         print('%s is not complete, run again to resume'%path)
+         return None
+   else:
+      print('%s is sent without ranges, in one stream'%url)
+      fetch_whole(url, part)
+   md5 = md5 or remote_md5(url)
+   start = time.time()
+   hashes = checksum.file_hashes(part)
+   if md5:
+      if hashes['md5'] != md5.lower():
+         print('%s md5 is %s, expected %s -- starting again next time'%(path,hashes['md5'],md5))
+         os.remove(part)
+         if os.path.exists(part + '.json'):
+            os.remove(part + '.json')
+         return None
+      print('md5 %s checked in %0.1f seconds'%(hashes['md5'],time.time() - start))
+   else:
+      print('No md5 for %s, not checked'%url)
+   os.replace(part, path)
+   if os.path.exists(part + '.json'):
+      os.remove(part + '.json')
+   checksum.remember(path, hashes)
+   return path
+
+def main():
+   args = parse_args()
+   if args.name and args.name.startswith('http'):
+      url = args.name
+      md5 = args.md5
+   else:
+      if args.name in BASES:
+         data = { 'base': {} }
+      elif not args.catalog.startswith('http') and not os.path.isfile(args.catalog):
+         print('Failed to open %s -- Quitting'%args.catalog)
+         sys.exit(1)
+      else:
+         data = load_catalog(args.catalog)
+      if args.list or not args.name:
+         for name in sorted(BASES):
+            print('%s %s'%(name,BASES[name]))
+         for group in ('maps','base'):
+            for (name, entry) in sorted(data.get(group,{}).items()):
+               print('%s %s %s'%(name,entry.get('mbtile_size',entry.get('size','-')),entry.get(args.url,'-')))
+         sys.exit(0)
+      if args.name in BASES:
+         url = BASES[args.name]
+         md5 = args.md5
+      else:
+         entry = find_entry(data, args.name, args.url)
+         if entry is None or not entry.get(args.url):
+            print('%s is not in %s -- Quitting'%(args.name,args.catalog))
+            sys.exit(1)
+         url = entry[args.url]
+         md5 = args.md5 or entry.get('md5')
+   if not os.path.isdir(args.output):
+      os.makedirs(args.output)
+   path = download(url, args.output, args.segments, md5)
+   print(httpclient.shared().summary())
+   if path is None:
+      sys.exit(1)
+   print('Saved %s'%path)
+
+if __name__ == "__main__":
+   main()
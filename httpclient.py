@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# One urllib3 pool manager for every module, with timeouts, retries and connection counts
+
+# shared() returns the client, made on first use. Its pools keep up to maxsize
+#   connections per host, which should be at least the number of threads
+#   fetching at once (fetch.WORKERS, or -w), and grow if a caller asks for
+#   more. configure() replaces it, before first use, from command line options.
+# Every request has connect and read timeouts, so one slow tile cannot hold a
+#   worker for long. Connection errors, timeouts, and the statuses in
+#   retry_status are tried again after a jittered, doubling wait (the longest
+#   of that and any Retry-After), up to "retries" times. wmts.WMTS passes
+#   no statuses, HostLimiter and sources.Sources act on those.
+# Counts, from the connection pools themselves: requests, attempts sent,
+#   handshakes (new connections) and so reuse, the share of attempts sent on
+#   a connection already open. stats() returns them, save_stats() writes json.
+
+import json
+import random
+import threading
+import time
+import certifi
+import urllib3
+from fetch import retry_after
+
+# connections kept per host
+MAXSIZE = 8
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 30.0
+RETRIES = 3
+# seconds, the first retry waits up to this, doubling each time up to BACKOFF_MAX
+BACKOFF = 0.5
+BACKOFF_MAX = 30.0
+RETRY_STATUS = (502, 503, 504)
+REDIRECTS = 5
+STATS = './work/http_stats.json'
+
+client = None
+client_lock = threading.Lock()
+
+def shared(maxsize=None):
+   global client
+   with client_lock:
+      if client is None:
+         client = HttpClient(max(maxsize or 0, MAXSIZE))
+      elif maxsize and maxsize > client.maxsize:
+         client.resize(maxsize)
+      return client
+
+def configure(maxsize=MAXSIZE, connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+   global client
+   with client_lock:
+      client = HttpClient(maxsize, connect, read, retries, backoff)
+      return client
+
+class HttpClient(object):
+
+   def __init__(self, maxsize=MAXSIZE, connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+      self.maxsize = maxsize
+      self.timeout = urllib3.Timeout(connect=connect, read=read)
+      self.retries = retries
+      self.backoff = backoff
+      # urllib3 follows redirects, failures come back here to be retried
+      self.http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where(),
+            maxsize=maxsize, timeout=self.timeout,
+            retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=REDIRECTS,
+                  raise_on_redirect=False, raise_on_status=False))
+      self.pools = {} # id -> every connection pool used, for the counts
+      self.counts = { 'requests': 0, 'retries': 0, 'failed': 0 }
+      self.lock = threading.Lock()
+
+   def resize(self, maxsize):
+      # pools made from now on keep maxsize connections, the old ones are closed
+      self.maxsize = maxsize
+      self.http.connection_pool_kw['maxsize'] = maxsize
+      self.http.clear()
+
+   def wait(self, attempt, response=None):
+      pause = random.uniform(0, min(BACKOFF_MAX, self.backoff * 2 ** attempt))
+      if response is not None:
+         pause = max(pause, retry_after(response) or 0)
+      time.sleep(pause)
+
+   def request(self, method, url, retry_status=RETRY_STATUS, **kw):
+      # as urllib3's request(), the last response or error when retries run out
+      pool = self.http.connection_from_url(url)
+      with self.lock:
+         self.pools[id(pool)] = pool
+         self.counts['requests'] += 1
+      attempt = 0
+      while True:
+         try:
+            response = self.http.request(method, url, **kw)
+            if response.status not in retry_status or attempt >= self.retries:
+               return response
+            response.drain_conn()
+         except (urllib3.exceptions.MaxRetryError, urllib3.exceptions.TimeoutError,
+                 urllib3.exceptions.ProtocolError):
+            if attempt >= self.retries:
+               with self.lock:
+                  self.counts['failed'] += 1
+               raise
+            response = None
+         with self.lock:
+            self.counts['retries'] += 1
+         self.wait(attempt, response)
+         attempt += 1
+
+   def stats(self):
+      with self.lock:
+         pools = list(self.pools.values())
+         out = dict(self.counts)
+      hosts = {}
+      for pool in pools:
+         host = hosts.setdefault('%s:%s'%(pool.host,pool.port), { 'attempts': 0, 'handshakes': 0 })
+         host['attempts'] += pool.num_requests
+         host['handshakes'] += pool.num_connections
+      out['attempts'] = sum([host['attempts'] for host in hosts.values()])
+      out['handshakes'] = sum([host['handshakes'] for host in hosts.values()])
+      out['reuse'] = 1.0 - out['handshakes'] / float(max(out['attempts'], 1))
+      out['hosts'] = hosts
+      out['maxsize'] = self.maxsize
+      out['timeout'] = { 'connect': self.timeout.connect_timeout, 'read': self.timeout.read_timeout }
+      return out
+
+   def summary(self):
+      stats = self.stats()
+      return 'http requests:%s retries:%s failed:%s handshakes:%s reuse:%0.1f%%'%(stats['requests'],\
+            stats['retries'],stats['failed'],stats['handshakes'],100.0 * stats['reuse'])
+
+   def save_stats(self, path=STATS):
+      with open(path, 'w') as stats_fp:
+         stats_fp.write(json.dumps(self.stats(), indent=2))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Load a zoom/column/row tile directory, or a tar of one, into an mbtiles
+
+# Files are found by their last three path parts, ZOOM/COLUMN/ROW.ext. A
+#   directory is walked in sorted order, a tar is read in one pass, and may be
+#   compressed or piped in ("-" is stdin).
+# Images are keyed by content hash (wmts.tile_hash), each is stored once.
+# A new file is loaded with no indexes and no journal, then AddIndexes builds
+#   them once at the end, keeping the last copy of a repeated tile. Into a
+#   file that already has tiles, they go through MBTiles.writer() instead.
+# With --check the tiles are classified (verify.py) in a pool of processes,
+#   "full" being the PIL decode, and bad ones are left out.
+# Metadata comes from Extract, with bounds from the deepest zoom loaded.
+
+import os, sys
+import argparse
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from download import MBTiles, Extract, BATCH_SIZE
+from wmts import tile_hash
+import tools
+import verify
+
+# tiles per transaction while bulk loading a new file
+LOAD_BATCH = 5000
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Import a tile directory or tar into an mbtiles.")
+   parser.add_argument("source", help="Directory, or tar archive (- for stdin).")
+   parser.add_argument("mbtiles", help="mbtiles to create or add to.")
+   parser.add_argument("--check", help="Check tiles before loading.", choices=verify.LEVELS)
+   parser.add_argument("-w", "--workers", help="Checking processes. (Default=cpu count)", type=int)
+   parser.add_argument("--tms", help="Flip rows between tms and xyz.", action='store_true')
+   parser.add_argument("-n", "--name", help="Metadata name. (Default=mbtiles file name)")
+   return parser.parse_args()
+
+def tile_address(path):
+   # (zoom, column, row) from .../ZOOM/COLUMN/ROW.ext, or None
+   parts = path.replace('\\', '/').split('/')
+   if len(parts) < 3:
+      return None
+   try:
+      return (int(parts[-3]), int(parts[-2]), int(parts[-1].split('.')[0]))
+   except ValueError:
+      return None
+
+def dir_tiles(source):
+   # yields (zoom, column, row, data)
+   for (dirpath, dirnames, filenames) in os.walk(source):
+      dirnames.sort(key=lambda name: (len(name), name))
+      for name in sorted(filenames):
+         path = os.path.join(dirpath, name)
+         address = tile_address(path)
+         if address:
+            with open(path, 'rb') as tile_fp:
+               yield address + (tile_fp.read(),)
+
+def tar_tiles(source):
+   # a file is opened for random access, so hard links can be followed, a
+   #   pipe can only be streamed, and its hard links are skipped
+   if source == '-':
+      archive = tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+   else:
+      archive = tarfile.open(source, mode='r:*')
+   skipped = 0
+   for member in archive:
+      if not (member.isfile() or member.islnk()):
+         continue
+      address = tile_address(member.name)
+      if not address:
+         continue
+      if member.islnk() and source == '-':
+         skipped += 1
+         continue
+      yield address + (archive.extractfile(member).read(),)
+   archive.close()
+   if skipped:
+      print('Skipped %s hard links, which cannot be followed in a stream'%skipped)
+
+def check_chunk(chunk, level):
+   # runs in a worker process, returns the tiles that pass
+   return [tile for tile in chunk if verify.classify(tile[3], level) in verify.GOOD]
+
+def checked(tiles, level, workers):
+   # keeps the order, a bounded number of chunks are out at once
+   chunk = []
+   pending = []
+   with ProcessPoolExecutor(max_workers=workers) as pool:
+      for tile in tiles:
+         chunk.append(tile)
+         if len(chunk) >= verify.CHUNK:
+            pending.append(pool.submit(check_chunk, chunk, level))
+            chunk = []
+            while len(pending) >= (workers or os.cpu_count()) * 2:
+               for tile in pending.pop(0).result():
+                  yield tile
+      pending.append(pool.submit(check_chunk, chunk, level))
+      for future in pending:
+         for tile in future.result():
+            yield tile
+
+def bulk_load(mbTiles, tiles):
+   # a new file, the indexes are made after
+   mbTiles.CheckSchema(indexes=False)
+   previous = mbTiles.SetPragmas({ 'journal_mode': 'OFF', 'synchronous': 'OFF' })
+   seen = set()
+   images = []
+   rows = []
+   count = 0
+   for (zoom, tileX, tileY, data) in tiles:
+      tile_id = tile_hash(data)
+      if tile_id not in seen:
+         seen.add(tile_id)
+         images.append((data, tile_id))
+      rows.append((zoom, tileX, tileY, tile_id))
+      if len(rows) >= LOAD_BATCH:
+         count += write_batch(mbTiles, images, rows)
+         images = []
+         rows = []
+   count += write_batch(mbTiles, images, rows)
+   mbTiles.SetPragmas(previous)
+   mbTiles.CheckSchema()
+   return count
+
+def write_batch(mbTiles, images, rows):
+   with mbTiles.conn:
+      mbTiles.c.executemany('INSERT INTO images (tile_data, tile_id) VALUES (?, ?)', images)
+      mbTiles.c.executemany('INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)', rows)
+   if rows:
+      print('+',flush=True,end="")
+   return len(rows)
+
+def writer_load(mbTiles, tiles):
+   count = 0
+   with mbTiles.writer(batch_size=BATCH_SIZE) as writer:
+      for (zoom, tileX, tileY, data) in tiles:
+         writer.put(zoom, tileX, tileY, data)
+         count += 1
+   return count
+
+def set_metadata(mbTiles, path, name, first_format):
+   # bounds are the edges of the tiles at the deepest zoom
+   bounds = mbTiles.get_bounds()
+   if not bounds:
+      return
+   top = max(bounds)
+   z = bounds[top]
+   (north, west) = tools.xy2latlon(z['minX'], z['minY'], top)
+   (south, east) = tools.xy2latlon(z['maxX'] + 1, z['maxY'] + 1, top)
+   extract = Extract(path, top=north, left=west, bottom=south, right=east,
+         min_zoom=min(bounds), max_zoom=top, center_zoom=min(top, max(min(bounds), 10)))
+   metadata = extract.metadata()
+   metadata['name'] = name
+   if first_format:
+      metadata['format'] = { 'jpeg': 'jpg' }.get(first_format, first_format)
+   for key in metadata:
+      mbTiles.SetMetaData(key, metadata[key])
+
+def import_tiles(source, path, check=None, workers=None, tms=False, name=None):
+   start = time.time()
+   if os.path.isdir(source):
+      tiles = dir_tiles(source)
+   else:
+      tiles = tar_tiles(source)
+   if tms:
+      tiles = ((zoom, tileX, (1 << zoom) - tileY - 1, data) for (zoom, tileX, tileY, data) in tiles)
+   if check:
+      tiles = checked(tiles, check, workers)
+   formats = []
+   def noted(tiles):
+      for tile in tiles:
+         if not formats:
+            formats.append(verify.image_format(tile[3]))
+         yield tile
+
+   new = not os.path.exists(path)
+   mbTiles = MBTiles(path)
+   if not new:
+      mbTiles.CheckSchema()
+      new = mbTiles.c.execute('SELECT 1 FROM map LIMIT 1').fetchone() is None
+   if new:
+      count = bulk_load(mbTiles, noted(tiles))
+   else:
+      count = writer_load(mbTiles, noted(tiles))
+   mbTiles.StaleStats()
+   set_metadata(mbTiles, path, name or os.path.basename(path), formats[0] if formats else None)
+   images = mbTiles.c.execute('SELECT count(*) FROM images').fetchone()[0]
+   elapsed = time.time() - start
+   print('\nImported %s tiles, %s distinct images, into %s in %0.1f seconds (%0.0f tiles/hour)'%(\
+         count,images,path,elapsed,count * 3600 / max(elapsed, 0.001)))
+   return count
+
+def main():
+   args = parse_args()
+   if args.source != '-' and not os.path.exists(args.source):
+      print('Failed to open %s -- Quitting'%args.source)
+      sys.exit(1)
+   import_tiles(args.source, args.mbtiles, args.check, args.workers, args.tms, args.name)
+
+if __name__ == "__main__":
+   main()
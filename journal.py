@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Record which tiles of each zoom are done, empty or failed, to resume downloads
+
+# Tiles are numbered row by row, index = tileY * 2**zoom + tileX, the order
+#   download_world walks a zoom. Each state of a zoom is a RangeSet of those
+#   indexes, kept in the journal table of the mbtiles as json [[start,end],..].
+# A restart skips whole ranges of done or empty tiles, so the cost depends
+#   on the number of ranges, not the number of tiles. Failed tiles are kept
+#   for reporting, and are tried again.
+
+import json
+from bisect import bisect_right
+
+STATES = ('done','empty','failed')
+
+class RangeSet(object):
+   # sorted, disjoint, half open ranges [start,end)
+
+   def __init__(self, ranges=()):
+      self.starts = [r[0] for r in ranges]
+      self.ends = [r[1] for r in ranges]
+
+   def __len__(self):
+      total = 0
+      for i in range(len(self.starts)):
+         total += self.ends[i] - self.starts[i]
+      return total
+
+   def __contains__(self, index):
+      k = bisect_right(self.starts, index)
+      return k > 0 and index < self.ends[k-1]
+
+   def ranges(self):
+      return [[self.starts[i], self.ends[i]] for i in range(len(self.starts))]
+
+   def add(self, index):
+      # appending in increasing order is the cheap, common case
+      k = bisect_right(self.starts, index)
+      if k > 0 and self.ends[k-1] >= index:
+         if self.ends[k-1] > index:
+            return
+         self.ends[k-1] = index + 1
+         if k < len(self.starts) and self.starts[k] == index + 1:
+            self.ends[k-1] = self.ends[k]
+            del self.starts[k]
+            del self.ends[k]
+         return
+      if k < len(self.starts) and self.starts[k] == index + 1:
+         self.starts[k] = index
+         return
+      self.starts.insert(k, index)
+      self.ends.insert(k, index + 1)
+
+   def discard(self, index):
+      k = bisect_right(self.starts, index)
+      if k == 0 or index >= self.ends[k-1]:
+         return
+      start, end = self.starts[k-1], self.ends[k-1]
+      del self.starts[k-1]
+      del self.ends[k-1]
+      if index + 1 < end:
+         self.starts.insert(k-1, index + 1)
+         self.ends.insert(k-1, end)
+      if start < index:
+         self.starts.insert(k-1, start)
+         self.ends.insert(k-1, index)
+
+   def skip(self, index):
+      # first index at or after this one that is not in the set
+      k = bisect_right(self.starts, index)
+      if k > 0 and index < self.ends[k-1]:
+         return self.ends[k-1]
+      return index
+
+class Journal(object):
+
+   def __init__(self, mbtiles):
+      self.mbtiles = mbtiles
+      self.sets = {} # (zoom, state) -> RangeSet
+      self.dirty = set()
+      sql = 'CREATE TABLE IF NOT EXISTS journal (zoom_level INTEGER,state TEXT,ranges TEXT)'
+      self.mbtiles.c.execute(sql)
+      self.mbtiles.Commit()
+
+   def get(self, zoom, state):
+      if (zoom, state) not in self.sets:
+         sql = 'SELECT ranges FROM journal WHERE zoom_level = ? AND state = ?'
+         row = self.mbtiles.c.execute(sql, (zoom, state)).fetchone()
+         if row:
+            self.sets[(zoom, state)] = RangeSet(json.loads(row[0]))
+         else:
+            self.sets[(zoom, state)] = RangeSet()
+      return self.sets[(zoom, state)]
+
+   def started(self, zoom):
+      sql = 'SELECT count(*) FROM journal WHERE zoom_level = ?'
+      return self.mbtiles.c.execute(sql, (zoom,)).fetchone()[0] > 0
+
+   def seed(self, zoom):
+      # a file that was never journaled, such as a copy of satellite.mbtiles,
+      #   is read once, the tiles it has are done
+      if self.started(zoom):
+         return
+      n = 2 ** zoom
+      done = self.get(zoom, 'done')
+      sql = 'SELECT tile_column, tile_row FROM map WHERE zoom_level = ? ORDER BY tile_row, tile_column'
+      for row in self.mbtiles.c.execute(sql, (zoom,)).fetchall():
+         done.add(row[1] * n + row[0])
+      self.dirty.add((zoom, 'done'))
+      self.save()
+
+   def mark(self, zoom, tileX, tileY, state):
+      index = tileY * 2 ** zoom + tileX
+      for other in STATES:
+         if other != state and index in self.get(zoom, other):
+            self.get(zoom, other).discard(index)
+            self.dirty.add((zoom, other))
+      self.get(zoom, state).add(index)
+      self.dirty.add((zoom, state))
+
+   def pending(self, zoom):
+      # yields (tileX, tileY) for every tile that is neither done nor empty
+      n = 2 ** zoom
+      done = self.get(zoom, 'done')
+      empty = self.get(zoom, 'empty')
+      index = 0
+      while index < n * n:
+         later = empty.skip(done.skip(index))
+         if later != index:
+            index = later
+            continue
+         yield (index % n, index // n)
+         index += 1
+
+   def count(self, zoom, state):
+      return len(self.get(zoom, state))
+
+   def save(self):
+      if len(self.dirty) == 0:
+         return
+      with self.mbtiles.conn:
+         for (zoom, state) in self.dirty:
+            self.mbtiles.c.execute('DELETE FROM journal WHERE zoom_level = ? AND state = ?',
+               (zoom, state))
+            self.mbtiles.c.execute('INSERT INTO journal (zoom_level, state, ranges) VALUES (?, ?, ?)',
+               (zoom, state, json.dumps(self.sets[(zoom, state)].ranges())))
+      self.dirty = set()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Merge mbtiles files into a new one, choosing one tile where sources overlap
+
+# Every source's map is read in (zoom, x, y) order, and the streams are
+#   merged, so each tile position is seen once with all of its candidates.
+#   The policy picks the winner:
+#      first   -- earliest source on the command line
+#      last    -- latest source on the command line (what merge_regions did)
+#      newest  -- source file modified most recently
+#      largest -- biggest tile_data
+# Map rows are written in index order. Then each source is attached in turn,
+#   and only the images its winning tiles refer to are copied, in one
+#   transaction per source.
+# The output has the schema of the first source, the base: its tables, views
+#   and indexes, copied from sqlite_master, and the rows of its other tables
+#   (metadata, omtm, ...). Only the unique indexes on map and images are
+#   added if the base lacks them. Per tile tables (PER_TILE) start empty.
+# Nothing in the output is ever replaced or deleted, so it has no free pages
+#   and needs no VACUUM. It is built under OUTPUT.part and renamed when done.
+#   It is not pre-sized, sqlite gives python no way to reserve the space.
+
+import os, sys
+import argparse
+import heapq
+import sqlite3
+import time
+import urllib.parse
+from download import MBTiles, BATCH_SIZE
+
+POLICIES = ('first','last','newest','largest')
+# tables of the base whose rows describe its own tiles, they are not copied
+PER_TILE = ('map','images','satdata','flat','upstream','journal')
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Merge mbtiles files into a new mbtiles.")
+   parser.add_argument("-o", "--output", help="New mbtiles to create.", required=True)
+   parser.add_argument("-p", "--policy", help="Which tile wins an overlap. (Default=last)",
+                       choices=POLICIES, default='last')
+   parser.add_argument("--page-size", help="sqlite page size of the output. (Default=4096)",
+                       type=int, default=4096)
+   parser.add_argument("sources", nargs='+', help="mbtiles to merge, metadata comes from the first.")
+   return parser.parse_args()
+
+def source_tiles(index, path):
+   # yields (zoom, x, y, source index, tile_id, size) in map_index order
+   conn = sqlite3.connect('file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(path)), uri=True)
+   sql = '''SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_id, length(images.tile_data)
+            FROM map JOIN images ON images.tile_id = map.tile_id
+            ORDER BY map.zoom_level, map.tile_column, map.tile_row'''
+   for row in conn.execute(sql):
+      yield (row[0], row[1], row[2], index, row[3], row[4])
+   conn.close()
+
+def choose(candidates, policy, mtimes):
+   # candidates are in source order
+   if policy == 'first':
+      return candidates[0]
+   if policy == 'last':
+      return candidates[-1]
+   if policy == 'newest':
+      return max(candidates, key=lambda c: (mtimes[c[3]], c[3]))
+   return max(candidates, key=lambda c: (c[5], c[3]))
+
+def winners(sources, policy):
+   # yields the winning candidate for every tile position
+   mtimes = [os.path.getmtime(path) for path in sources]
+   streams = [source_tiles(i, path) for i, path in enumerate(sources)]
+   candidates = []
+   for tile in heapq.merge(*streams):
+      if candidates and tile[:3] != candidates[0][:3]:
+         yield choose(candidates, policy, mtimes)
+         candidates = []
+      candidates.append(tile)
+   if candidates:
+      yield choose(candidates, policy, mtimes)
+
+def copy_schema(mbTiles, base):
+   # the base's tables, views, indexes and triggers, and the rows of all but
+   #   the tile tables, then the unique indexes the merge relies on
+   mbTiles.c.execute('ATTACH DATABASE "%s" as src'%base)
+   sql = '''SELECT type, name, sql FROM src.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END'''
+   with mbTiles.conn:
+      for (kind, name, ddl) in mbTiles.c.execute(sql).fetchall():
+         mbTiles.c.execute(ddl)
+         if kind == 'table' and name not in PER_TILE:
+            mbTiles.c.execute('INSERT INTO main."%s" SELECT * FROM src."%s"'%(name,name))
+   mbTiles.c.execute('DETACH DATABASE src')
+   for (table, columns, index) in (('map', ['zoom_level','tile_column','tile_row'], 'map_index'),
+                                   ('images', ['tile_id'], 'images_index')):
+      if not mbTiles.HasUniqueIndex(table, columns):
+         mbTiles.c.execute('DROP INDEX IF EXISTS %s'%index)
+         mbTiles.c.execute('CREATE UNIQUE INDEX %s ON %s (%s)'%(index,table,','.join(columns)))
+   mbTiles.Commit()
+
+def merge(output, sources, policy='last', page_size=4096):
+   work = output + '.part'
+   if os.path.exists(work):
+      os.remove(work)
+   mbTiles = MBTiles(work)
+   # a new file, that is thrown away if the merge fails, needs no journal
+   mbTiles.c.execute('PRAGMA page_size = %s'%page_size)
+   mbTiles.SetPragmas({ 'journal_mode': 'OFF', 'synchronous': 'OFF' })
+   copy_schema(mbTiles, sources[0])
+   mbTiles.c.execute('CREATE TEMP TABLE winners (source INTEGER, tile_id TEXT, size INTEGER)')
+
+   start = time.time()
+   rows = []
+   chosen = []
+   tiles = 0
+   for (zoom, tileX, tileY, index, tile_id, size) in winners(sources, policy):
+      rows.append((zoom, tileX, tileY, tile_id))
+      chosen.append((index, tile_id, size))
+      if len(rows) >= BATCH_SIZE:
+         mbTiles.c.executemany('INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)', rows)
+         mbTiles.c.executemany('INSERT INTO temp.winners (source, tile_id, size) VALUES (?, ?, ?)', chosen)
+         tiles += len(rows)
+         rows = []
+         chosen = []
+   mbTiles.c.executemany('INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)', rows)
+   mbTiles.c.executemany('INSERT INTO temp.winners (source, tile_id, size) VALUES (?, ?, ?)', chosen)
+   tiles += len(rows)
+   mbTiles.Commit()
+   size = mbTiles.c.execute('SELECT sum(size) FROM (SELECT DISTINCT tile_id, size FROM temp.winners)').fetchone()[0]
+   print('Tiles:%s Image bytes:%s chosen in %0.1f seconds'%(tiles,size,time.time()-start))
+
+   for index, path in enumerate(sources):
+      mbTiles.c.execute('ATTACH DATABASE "%s" as src'%path)
+      with mbTiles.conn:
+         sql = '''INSERT OR IGNORE INTO images (tile_data, tile_id)
+                  SELECT src.images.tile_data, src.images.tile_id FROM src.images
+                  WHERE src.images.tile_id IN (SELECT tile_id FROM temp.winners WHERE source = ?)'''
+         mbTiles.c.execute(sql, (index,))
+         print('%s images from %s'%(mbTiles.c.rowcount,path))
+      mbTiles.c.execute('DETACH DATABASE src')
+
+   mbTiles.c.execute('DROP TABLE temp.winners')
+   mbTiles.SetPragmas({ 'journal_mode': 'DELETE', 'synchronous': 'FULL' })
+   mbTiles = None
+   os.rename(work, output)
+   print('Merged %s files into %s, %s bytes in %0.1f seconds'%(len(sources),output,\
+         os.path.getsize(output),time.time()-start))
+
+def main():
+   args = parse_args()
+   if os.path.exists(args.output):
+      print('%s already exists -- Quitting'%args.output)
+      sys.exit(1)
+   merge(args.output, args.sources, args.policy, args.page_size)
+
+if __name__ == "__main__":
+   main()
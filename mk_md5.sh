@@ -1,11 +1,6 @@
 #!/bin/bash 
 # insure that every *.mbtiles file in PREFIX has a md5sum file alongside
+# checksum.py hashes them in parallel, and skips those that have not changed
 
 PREFIX=/hd/maps/maps-2020/staged
-for f in $PREFIX/*.mbtiles;do
-   if [ ! -f $PREFIX.md5 ]; then
-      echo Executing md5sum $f \> $f.md5
-      md5sum $f \> $f.md5
-   fi
-done
-
+python3 $(dirname $0)/checksum.py $PREFIX
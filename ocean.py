@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Find tiles of one flat colour, mostly open ocean, store them once and skip below them
+
+# A tile is flat when every pixel of a thumbnail (a jpeg is decoded straight
+#   to 1/4 size) is within SPREAD of the most common value, in each channel of
+#   the histogram. Its colour is the mean, rounded to STEP.
+# Flat water tiles (is_water) that are downloaded are written as one shared
+#   image per colour (shared_tile), so they cost a map row, and are listed
+#   with their colour in the "flat" table. The journal marks them 'empty'
+#   rather than 'done'. Other flat tiles, cloud, snow or night, are kept as
+#   they came. --share replaces every flat tile of a zoom already in a file.
+# The land mask is the flat water tiles of one coarse zoom (MASK_ZOOM). Every
+#   tile below one of them is ocean, it is given the same shared image and is
+#   never requested. Those tiles are not added to the flat table, their
+#   ancestor stands for them.
+# A zoom already in a file is classified once, in a pool of processes, and
+#   marked in satdata so that it is not done again.
+
+import os, sys
+import argparse
+import time
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+import verify
+
+# side of the thumbnail whose histogram is looked at
+THUMB = 64
+# largest distance of any channel value from the most common one
+SPREAD = 6
+# colours are rounded to this step, so near colours share one image
+STEP = 4
+# the zoom of the land mask, lower is coarser and misses more small islands
+MASK_ZOOM = 9
+# water is bluer than it is red by at least this much
+WATER_MARGIN = 10
+TILE_SIZE = 256
+FORMATS = { 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP' }
+shared = {} # (color, format) -> encoded tile
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Find the flat tiles of an mbtiles.")
+   parser.add_argument("mbtiles", help="mbtiles filename.")
+   parser.add_argument("-z", "--zoom", help="Zoom to classify. (Default=%s)"%MASK_ZOOM, type=int,
+                       default=MASK_ZOOM)
+   parser.add_argument("-s", "--share", help="Replace flat tiles by the shared image of their colour.",
+                       action='store_true')
+   parser.add_argument("-w", "--workers", help="Processes. (Default=cpu count)", type=int)
+   return parser.parse_args()
+
+def flat_color(data):
+   # (r, g, b) if the tile is one colour, else None
+   try:
+      image = Image.open(BytesIO(data))
+      image.draft('RGB', (THUMB, THUMB))
+      image = image.convert('RGB')
+      if image.size != (THUMB, THUMB):
+         image = image.resize((THUMB, THUMB))
+   except Exception:
+      return None
+   histogram = image.histogram()
+   color = []
+   for channel in range(3):
+      counts = histogram[channel * 256:(channel + 1) * 256]
+      mode = counts.index(max(counts))
+      low = max(0, mode - SPREAD)
+      near = counts[low:mode + SPREAD + 1]
+      if sum(near) < THUMB * THUMB:
+         return None
+      mean = sum([(low + i) * n for (i, n) in enumerate(near)]) / float(THUMB * THUMB)
+      color.append(min(255, int(round(mean / STEP)) * STEP))
+   return tuple(color)
+
+def is_water(color):
+   return color[2] >= color[1] and color[2] >= color[0] + WATER_MARGIN
+
+def shared_tile(color, fmt='jpeg'):
+   # the one image stored for every flat tile of this colour
+   fmt = fmt if fmt in FORMATS else 'jpeg'
+   if (color, fmt) not in shared:
+      out = BytesIO()
+      Image.new('RGB', (TILE_SIZE, TILE_SIZE), color).save(out, FORMATS[fmt])
+      shared[(color, fmt)] = out.getvalue()
+   return shared[(color, fmt)]
+
+def color_text(color):
+   return '%s,%s,%s'%color
+
+def classify_chunk(chunk):
+   # runs in a worker process, chunk is [(x, y, data)],
+   #   returns [(x, y, color, format)] of the flat ones
+   flat = []
+   for (tileX, tileY, data) in chunk:
+      color = flat_color(data)
+      if color:
+         flat.append((tileX, tileY, color, verify.image_format(data)))
+   return flat
+
+class Sparse(object):
+   # the flat tiles of an mbtiles, and their colour
+
+   def __init__(self, mbtiles):
+      self.mbtiles = mbtiles
+      sql = 'CREATE TABLE IF NOT EXISTS flat (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,color TEXT)'
+      self.mbtiles.c.execute(sql)
+      sql = 'CREATE UNIQUE INDEX IF NOT EXISTS flat_index ON flat (zoom_level,tile_column,tile_row)'
+      self.mbtiles.c.execute(sql)
+      self.mbtiles.Commit()
+
+   def add(self, zoom, tileX, tileY, color):
+      # committed with the writer's next batch
+      self.mbtiles.c.execute('INSERT OR REPLACE INTO flat (zoom_level, tile_column, tile_row, color) VALUES (?, ?, ?, ?)',
+            (zoom, tileX, tileY, color_text(color)))
+
+   def colors(self, zoom):
+      # {(x, y): (r, g, b)}
+      sql = 'SELECT tile_column, tile_row, color FROM flat WHERE zoom_level = ?'
+      return dict([((row[0], row[1]), tuple([int(v) for v in row[2].split(',')]))
+            for row in self.mbtiles.c.execute(sql, (zoom,))])
+
+   def count(self, zoom):
+      return self.mbtiles.c.execute('SELECT count(*) FROM flat WHERE zoom_level = ?', (zoom,)).fetchone()[0]
+
+   def classified(self, zoom):
+      return 'flat' in self.mbtiles.GetSatMetaData(zoom)
+
+   def classify_zoom(self, zoom, workers=None, share=False):
+      # every tile of the zoom, with share flat ones are rewritten as the
+      #   shared image of their colour. Returns the number that are flat.
+      workers = workers or os.cpu_count()
+      start = time.time()
+      sql = '''SELECT map.tile_column, map.tile_row, images.tile_data FROM map
+               JOIN images ON images.tile_id = map.tile_id WHERE map.zoom_level = ?
+               ORDER BY map.tile_column, map.tile_row'''
+      flat = []
+      chunk = []
+      pending = set()
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+         for row in self.mbtiles.conn.execute(sql, (zoom,)):
+            chunk.append((row[0], row[1], bytes(row[2])))
+            if len(chunk) >= verify.CHUNK:
+               pending.add(pool.submit(classify_chunk, chunk))
+               chunk = []
+               while len(pending) >= workers * 2:
+                  finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                  for future in finished:
+                     flat += future.result()
+         pending.add(pool.submit(classify_chunk, chunk))
+         for future in pending:
+            flat += future.result()
+      with self.mbtiles.writer() as writer:
+         for (tileX, tileY, color, fmt) in flat:
+            self.add(zoom, tileX, tileY, color)
+            if share:
+               writer.put(zoom, tileX, tileY, shared_tile(color, fmt))
+      self.mbtiles.SetSatMetaData(zoom, 'flat', str(len(flat)))
+      print('zoom %s flat:%s water:%s in %0.1f seconds'%(zoom,len(flat),\
+            len([tile for tile in flat if is_water(tile[2])]),time.time()-start))
+      return len(flat)
+
+class LandMask(object):
+   # which tiles are below a flat water tile of the mask zoom
+
+   def __init__(self, sparse, zoom=MASK_ZOOM, workers=None):
+      if not sparse.classified(zoom):
+         sparse.classify_zoom(zoom, workers)
+      self.zoom = zoom
+      self.water = dict([(key, color) for (key, color) in sparse.colors(zoom).items() if is_water(color)])
+
+   def ocean(self, zoom, tileX, tileY):
+      # the colour of the ocean this tile is in, or None if it may have land
+      if zoom <= self.zoom:
+         return None
+      shift = zoom - self.zoom
+      return self.water.get((tileX >> shift, tileY >> shift))
+
+def main():
+   # download.py imports this module, it is only imported back when run alone
+   import download
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('Failed to open %s -- Quitting'%args.mbtiles)
+      sys.exit(1)
+   mbTiles = download.MBTiles(args.mbtiles)
+   mbTiles.CheckSchema()
+   Sparse(mbTiles).classify_zoom(args.zoom, args.workers, args.share)
+
+if __name__ == "__main__":
+   main()
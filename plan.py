@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Size a download, list the tiles of a region missing from an mbtiles, per zoom
+
+# The region's bbox is turned into tile limits for every zoom in one call
+#   (tools.bboxTileLimits). The tiles present are read per zoom with one range
+#   query, answered from map_index alone, in (column, row) order. The gaps in
+#   each column are runs of rows, and neighbouring columns with the same runs
+#   are joined, so the plan is a short list of rectangles [x0,x1,y0,y1), one
+#   past the end as in bbox_tile_limits.
+# Estimates:
+#   bytes -- mean stored tile size at that zoom (or the nearest zoom sampled)
+#   time  -- the tiles per second download_world recorded in satdata as
+#            'rate', or --rate
+# Regions come from regions.json ("regions") or map-catalog.json ("maps").
+
+import os, sys
+import argparse
+import json
+import sqlite3
+import urllib.parse
+import tools
+
+REGIONS = './regions.json'
+# tiles sampled per zoom for the mean size
+SAMPLE = 1000
+# used when nothing has been measured, bytes per tile and tiles per second
+DEFAULT_BYTES = 20000
+DEFAULT_RATE = 8.0
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Plan the download of a region.")
+   parser.add_argument("-m", "--mbtiles", help="mbtiles to compare against.", required=True)
+   parser.add_argument("-r", "--region", help="Region name. (Default=world)", default='world')
+   parser.add_argument("-c", "--catalog", help="regions.json or map-catalog.json. (Default=%s)"%REGIONS,
+                       default=REGIONS)
+   parser.add_argument("--min", help="First zoom. (Default=0)", type=int, default=0)
+   parser.add_argument("-z", "--zoom", help="Last zoom. (Default=13)", type=int, default=13)
+   parser.add_argument("--rate", help="Tiles per second, instead of the measured rate.", type=float)
+   parser.add_argument("-o", "--output", help="Write the plan as json.")
+   return parser.parse_args()
+
+def get_region(catalog, region):
+   # returns {'west':..,'south':..,'east':..,'north':..}
+   with open(catalog,'r') as catalog_fp:
+      data = json.loads(catalog_fp.read())
+   for key in ('regions','maps'):
+      if region in data.get(key,{}):
+         box = data[key][region]
+         return dict([(side, float(box[side])) for side in ('west','south','east','north')])
+   print('Region %s not found in %s'%(region,catalog))
+   sys.exit(1)
+
+def missing_runs(present, y0, y1):
+   # present is a sorted list of rows, returns the gaps in [y0,y1)
+   runs = []
+   start = y0
+   for row in present:
+      if row > start:
+         runs.append((start, row))
+      start = row + 1
+   if start < y1:
+      runs.append((start, y1))
+   return runs
+
+def zoom_plan(conn, zoom, x0, x1, y0, y1):
+   # returns (tiles present, [[x0,x1,y0,y1],..] missing)
+   sql = '''SELECT tile_column, tile_row FROM map WHERE zoom_level = ?
+            AND tile_column >= ? AND tile_column < ? AND tile_row >= ? AND tile_row < ?
+            ORDER BY tile_column, tile_row'''
+   columns = {}
+   present = 0
+   for row in conn.execute(sql, (zoom, x0, x1, y0, y1)):
+      columns.setdefault(row[0], []).append(row[1])
+      present += 1
+   rects = []
+   for x in range(x0, x1):
+      runs = missing_runs(columns.get(x, []), y0, y1)
+      if rects and rects[-1][1] == x and rects[-1][4] == runs:
+         rects[-1][1] = x + 1
+      else:
+         rects.append([x, x + 1, y0, y1, runs])
+   missing = []
+   for (rx0, rx1, ry0, ry1, runs) in rects:
+      for (start, end) in runs:
+         missing.append([rx0, rx1, start, end])
+   return (present, missing)
+
+def mean_sizes(conn, zooms):
+   # {zoom: mean bytes}, from up to SAMPLE tiles of each zoom
+   sizes = {}
+   sql = '''SELECT avg(length(images.tile_data)) FROM
+            (SELECT tile_id FROM map WHERE zoom_level = ? LIMIT ?) AS sample
+            JOIN images ON images.tile_id = sample.tile_id'''
+   for zoom in zooms:
+      row = conn.execute(sql, (zoom, SAMPLE)).fetchone()
+      if row[0]:
+         sizes[zoom] = row[0]
+   for zoom in zooms:
+      if zoom not in sizes:
+         near = sorted(sizes, key=lambda z: abs(z - zoom))
+         sizes[zoom] = sizes[near[0]] if near else DEFAULT_BYTES
+   return sizes
+
+def measured_rate(conn):
+   # the last rate download_world recorded, at the deepest zoom
+   try:
+      sql = "SELECT value FROM satdata WHERE name = 'rate' ORDER BY CAST(zoom_level AS INTEGER) DESC"
+      for row in conn.execute(sql):
+         if float(row[0]) > 0:
+            return float(row[0])
+   except (sqlite3.OperationalError, ValueError):
+      pass
+   return None
+
+def plan(path, box, zooms, rate=None):
+   # returns {zoom: {'limits','present','missing','ranges','bytes','seconds'}}
+   conn = sqlite3.connect('file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(path)), uri=True)
+   zooms = list(zooms)
+   limits = tools.bboxTileLimits(box['west'],box['south'],box['east'],box['north'],zooms)
+   sizes = mean_sizes(conn, zooms)
+   rate = rate or measured_rate(conn) or DEFAULT_RATE
+   result = {}
+   for i, zoom in enumerate(zooms):
+      (x0, x1, y0, y1) = [int(a[i]) for a in limits]
+      (present, ranges) = zoom_plan(conn, zoom, x0, x1, y0, y1)
+      missing = sum([(r[1] - r[0]) * (r[3] - r[2]) for r in ranges])
+      result[zoom] = { 'limits': [x0, x1, y0, y1], 'present': present, 'missing': missing,
+                       'ranges': ranges, 'bytes': int(missing * sizes[zoom]),
+                       'seconds': missing / rate }
+   conn.close()
+   return result
+
+def report(result):
+   total = { 'present': 0, 'missing': 0, 'bytes': 0, 'seconds': 0 }
+   print('%5s %12s %12s %8s %10s %10s'%('ZOOM','PRESENT','MISSING','RANGES','BYTES','HOURS'))
+   for zoom in sorted(result):
+      z = result[zoom]
+      print('%5s %12s %12s %8s %10s %10.2f'%(zoom,z['present'],z['missing'],len(z['ranges']),\
+            human_bytes(z['bytes']),z['seconds']/3600))
+      for key in total:
+         total[key] += z[key]
+   print('%5s %12s %12s %8s %10s %10.2f'%('ALL',total['present'],total['missing'],'',\
+         human_bytes(total['bytes']),total['seconds']/3600))
+
+def human_bytes(num):
+   for unit in ('','K','M','G','T'):
+      if num < 1000:
+         return '%0.1f%s'%(num,unit)
+      num /= 1000.0
+   return '%0.1fP'%num
+
+def main():
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('Failed to open %s -- Quitting'%args.mbtiles)
+      sys.exit(1)
+   box = get_region(args.catalog, args.region)
+   result = plan(args.mbtiles, box, range(args.min, args.zoom + 1), args.rate)
+   report(result)
+   if args.output:
+      with open(args.output,'w') as plan_fp:
+         plan_fp.write(json.dumps(result,indent=2))
+
+if __name__ == "__main__":
+   main()
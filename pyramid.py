@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Build the lower zooms of an mbtiles from the zoom below, instead of downloading them
+
+# Each tile of zoom z is made from its four children at z+1 (the quad of
+#   download.fetch_quad_for): they are pasted into a mosaic twice the size,
+#   which is scaled down to one tile. Missing children are left as FILL.
+# Children are read two columns at a time, in map_index order, and the
+#   mosaics are made in a pool of processes. Tiles are written through
+#   MBTiles.writer(), and each zoom is finished before the next one up is
+#   built from it.
+# Rows are taken as xyz (row 0 at the north), as the satellite files store
+#   them, --tms when they are the other way up.
+
+import os, sys
+import argparse
+import time
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+
+FILL = (0, 0, 0)
+FORMATS = { 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP' }
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Build lower zooms of an mbtiles from higher ones.")
+   parser.add_argument("mbtiles", help="mbtiles filename.")
+   parser.add_argument("-z", "--zoom", help="Zoom whose tiles are the source. (Default=deepest)", type=int)
+   parser.add_argument("--min", help="Lowest zoom to build. (Default=0)", type=int, default=0)
+   parser.add_argument("-f", "--format", help="Format of the new tiles. (Default=jpeg)",
+                       choices=sorted(FORMATS), default='jpeg')
+   parser.add_argument("-q", "--quality", help="jpeg or webp quality. (Default=85)", type=int, default=85)
+   parser.add_argument("-w", "--workers", help="Processes. (Default=cpu count)", type=int)
+   parser.add_argument("--tms", help="Rows are tms, row 0 at the south.", action='store_true')
+   return parser.parse_args()
+
+def build_tile(zoom, tileX, tileY, children, tms=False, fmt='jpeg', quality=85):
+   # runs in a worker process, children is {(dx, dy): tile_data} with
+   #   dx, dy in 0,1 as offsets of the child's column and row
+   images = {}
+   size = 256
+   for (offset, data) in children.items():
+      try:
+         images[offset] = Image.open(BytesIO(data)).convert('RGB')
+         size = images[offset].size[0]
+      except Exception:
+         pass
+   if not images:
+      return (zoom, tileX, tileY, None)
+   mosaic = Image.new('RGB', (size * 2, size * 2), FILL)
+   for ((dx, dy), image) in images.items():
+      if tms:
+         dy = 1 - dy
+      if image.size != (size, size):
+         image = image.resize((size, size), Image.LANCZOS)
+      mosaic.paste(image, (dx * size, dy * size))
+   tile = mosaic.resize((size, size), Image.LANCZOS)
+   out = BytesIO()
+   if fmt == 'png':
+      tile.save(out, FORMATS[fmt], optimize=True)
+   else:
+      tile.save(out, FORMATS[fmt], quality=quality)
+   return (zoom, tileX, tileY, out.getvalue())
+
+def parents(mbTiles, zoom):
+   # yields (parent x, parent y, children) for every tile of zoom-1 that
+   #   has a child at zoom
+   sql = '''SELECT map.tile_column, map.tile_row, images.tile_data FROM map
+            JOIN images ON images.tile_id = map.tile_id
+            WHERE map.zoom_level = ? AND map.tile_column >= ? AND map.tile_column <= ?
+            ORDER BY map.tile_column, map.tile_row'''
+   conn = mbTiles.conn
+   top = conn.execute('SELECT max(tile_column) FROM map WHERE zoom_level = ?', (zoom,)).fetchone()[0]
+   left = conn.execute('SELECT min(tile_column) FROM map WHERE zoom_level = ?', (zoom,)).fetchone()[0]
+   if top is None:
+      return
+   for parentX in range(left // 2, top // 2 + 1):
+      quads = {}
+      for row in conn.execute(sql, (zoom, parentX * 2, parentX * 2 + 1)).fetchall():
+         quads.setdefault(row[1] // 2, {})[(row[0] % 2, row[1] % 2)] = bytes(row[2])
+      for parentY in sorted(quads):
+         yield (parentX, parentY, quads[parentY])
+
+def build_zoom(mbTiles, zoom, pool, workers, tms=False, fmt='jpeg', quality=85):
+   # makes zoom from zoom+1, returns the number of tiles written
+   pending = set()
+   written = 0
+   with mbTiles.writer() as writer:
+      def drain(pending):
+         finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+         done = 0
+         for future in finished:
+            (z, tileX, tileY, data) = future.result()
+            if data:
+               writer.put(z, tileX, tileY, data)
+               done += 1
+         return (pending, done)
+      for (tileX, tileY, children) in parents(mbTiles, zoom + 1):
+         pending.add(pool.submit(build_tile, zoom, tileX, tileY, children, tms, fmt, quality))
+         while len(pending) >= workers * 4:
+            pending, done = drain(pending)
+            written += done
+      while len(pending) > 0:
+         pending, done = drain(pending)
+         written += done
+   return written
+
+def build(mbTiles, source_zoom, min_zoom=0, workers=None, tms=False, fmt='jpeg', quality=85):
+   # builds source_zoom-1 down to min_zoom
+   workers = workers or os.cpu_count()
+   start = time.time()
+   with ProcessPoolExecutor(max_workers=workers) as pool:
+      for zoom in range(source_zoom - 1, min_zoom - 1, -1):
+         zoom_start = time.time()
+         written = build_zoom(mbTiles, zoom, pool, workers, tms, fmt, quality)
+         print('zoom %s built from zoom %s, %s tiles in %0.1f seconds'%(zoom,zoom+1,written,\
+               time.time()-zoom_start))
+   print('Overviews done in %0.1f seconds'%(time.time()-start))
+
+def main():
+   # download.py imports this module, it is only imported back when run alone
+   import download
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('Failed to open %s -- Quitting'%args.mbtiles)
+      sys.exit(1)
+   mbTiles = download.MBTiles(args.mbtiles)
+   mbTiles.CheckSchema()
+   zoom = args.zoom
+   if zoom is None:
+      zoom = mbTiles.c.execute('SELECT max(zoom_level) FROM map').fetchone()[0] or 0
+   build(mbTiles, zoom, args.min, args.workers, args.tms, args.format, args.quality)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Serve the tiles of mbtiles files over http, with tilejson, for local clients
+
+# Routes, NAME is the file name without .mbtiles:
+#   /NAME/{z}/{x}/{y}[.ext]   a tile
+#   /NAME.json                tilejson, from download.Extract.metadata()
+#   /{z}/{x}/{y}[.ext]        a tile of the first file
+#   /tilejson.json            tilejson of the first file
+# Rows are flipped from the xyz of the request to the tms of the file, as the
+#   package_tiles view in merge_regions does, for files whose scheme is tms.
+#   With --scheme auto each file's is the 'scheme' in its metadata, else tms.
+#   download.py writes 'xyz' there for its satellite files (WMTS rows), older
+#   ones written before that need --scheme xyz.
+# Files are read with sqlite's locking and change checks, as refresh or
+#   download may be writing them. --immutable skips those, only for files
+#   nothing writes while they are served.
+# The tile_id is the ETag (a content hash, since tiles are keyed that way), so
+#   an If-None-Match that still matches is answered 304 with no body.
+# Gzipped pbf is sent as stored, with Content-Encoding: gzip, to clients that
+#   accept it and unzipped to the rest, with Vary: Accept-Encoding either way.
+# Each file has one MBTilesReader, shared by the worker threads that read
+#   sqlite, each with its own connection. Tiles in its LRU are answered
+#   without leaving the event loop.
+
+import os, sys
+import argparse
+import asyncio
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
+from download import MBTilesReader, Extract, READER_CACHE
+import verify
+
+PORT = 8080
+WORKERS = 4
+# seconds clients may keep a tile without asking again
+MAX_AGE = 3600
+# longest request head read before the connection is dropped
+MAX_HEAD = 16384
+CONTENT_TYPES = { 'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp',
+                  'pbf': 'application/x-protobuf' }
+REASONS = { 200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed' }
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Serve mbtiles over http.")
+   parser.add_argument("mbtiles", nargs='+', help="mbtiles files to serve.")
+   parser.add_argument("--host", help="Address to listen on. (Default=0.0.0.0)", default='0.0.0.0')
+   parser.add_argument("-p", "--port", help="Port to listen on. (Default=%s)"%PORT, type=int, default=PORT)
+   parser.add_argument("-s", "--scheme", help="Row order in the files, auto is found per file. (Default=auto)",
+                       choices=('auto','tms','xyz'), default='auto')
+   parser.add_argument("--immutable", help="The files are not written while served, skip sqlite's checks.",
+                       action='store_true')
+   parser.add_argument("-w", "--workers", help="Threads reading sqlite. (Default=%s)"%WORKERS,
+                       type=int, default=WORKERS)
+   parser.add_argument("--cache", help="MB of tiles kept per file. (Default=%s)"%(READER_CACHE // 1000000),
+                       type=int, default=READER_CACHE // 1000000)
+   return parser.parse_args()
+
+def file_scheme(reader):
+   # the row order of a file, see the notes at the top
+   scheme = reader.GetAllMetaData().get('scheme','tms')
+   return scheme if scheme in ('tms','xyz') else 'tms'
+
+class TileServer(object):
+
+   def __init__(self, paths, scheme='auto', workers=WORKERS, cache_bytes=READER_CACHE, immutable=False):
+      self.sources = {} # name -> MBTilesReader, first file is also ''
+      self.schemes = {} # name -> 'tms' or 'xyz'
+      for path in paths:
+         name = os.path.basename(path)
+         if name.endswith('.mbtiles'):
+            name = name[:-len('.mbtiles')]
+         self.sources[name] = MBTilesReader(path, cache_bytes, immutable)
+         self.schemes[name] = scheme if scheme != 'auto' else file_scheme(self.sources[name])
+         self.sources.setdefault('', self.sources[name])
+         self.schemes.setdefault('', self.schemes[name])
+      self.pool = ThreadPoolExecutor(max_workers=workers)
+      self.tilejsons = {}
+
+   def tilejson(self, name, host):
+      # built once per file from its metadata table, as set_metadata wrote it
+      if name not in self.tilejsons:
+         reader = self.sources[name]
+         meta = reader.GetAllMetaData()
+         bounds = [float(v) for v in meta.get('bounds','-180,-85.0511,180,85.0511').split(',')]
+         center = meta.get('center','0,0,2').split(',')
+         extract = Extract(reader.filename, top=bounds[3], left=bounds[0], bottom=bounds[1],
+               right=bounds[2], min_zoom=int(meta.get('minzoom',0)), max_zoom=int(meta.get('maxzoom',14)),
+               center_zoom=int(float(center[2])))
+         tilejson = extract.metadata()
+         for key in ('name','attribution','description','version','format'):
+            if key in meta:
+               tilejson[key] = meta[key]
+         tilejson['tilejson'] = '2.2.0'
+         tilejson['scheme'] = 'xyz'
+         tilejson['bounds'] = bounds
+         tilejson['center'] = [float(v) for v in extract.center().split(',')]
+         self.tilejsons[name] = tilejson
+      tilejson = dict(self.tilejsons[name])
+      prefix = '/%s'%name if name else ''
+      tilejson['tiles'] = ['http://%s%s/{z}/{x}/{y}'%(host, prefix)]
+      return json.dumps(tilejson, indent=2).encode()
+
+   async def tile(self, name, zoom, tileX, tileY):
+      # returns (tile_id, tile_data), or None if it is not in the file
+      reader = self.sources[name]
+      if self.schemes[name] == 'tms':
+         tileY = (1 << zoom) - tileY - 1
+      tile = reader.Cached(zoom, tileX, tileY)
+      if tile:
+         return tile
+      try:
+         return await asyncio.get_running_loop().run_in_executor(self.pool,
+               reader.GetTileAndId, zoom, tileX, tileY)
+      except RuntimeError:
+         return None
+
+   def route(self, path):
+      # returns ('tile', name, z, x, y), ('tilejson', name), or None
+      parts = path.split('?')[0].strip('/').split('/')
+      if len(parts) == 1 and parts[0].endswith('.json'):
+         name = parts[0][:-len('.json')]
+         if name == 'tilejson':
+            name = ''
+         if name in self.sources:
+            return ('tilejson', name)
+         return None
+      if len(parts) == 3:
+         parts = [''] + parts
+      if len(parts) != 4 or parts[0] not in self.sources:
+         return None
+      try:
+         zoom = int(parts[1])
+         tileX = int(parts[2])
+         tileY = int(parts[3].split('.')[0])
+      except ValueError:
+         return None
+      if zoom < 0 or zoom > 30 or not (0 <= tileX < (1 << zoom)) or not (0 <= tileY < (1 << zoom)):
+         return None
+      return ('tile', parts[0], zoom, tileX, tileY)
+
+   async def respond(self, method, path, headers):
+      # returns (status, headers, body)
+      if method not in ('GET','HEAD'):
+         return (405, {}, b'')
+      route = self.route(path)
+      if route is None:
+         return (404, {}, b'')
+      if route[0] == 'tilejson':
+         return (200, { 'Content-Type': 'application/json' }, self.tilejson(route[1], headers.get('host','localhost')))
+      tile = await self.tile(*route[1:])
+      if tile is None:
+         return (404, {}, b'')
+      (tile_id, data) = tile
+      etag = '"%s"'%tile_id
+      out = { 'ETag': etag, 'Cache-Control': 'max-age=%s'%MAX_AGE }
+      if headers.get('if-none-match','').find(etag) != -1:
+         return (304, out, b'')
+      kind = verify.image_format(data)
+      out['Content-Type'] = CONTENT_TYPES.get(kind, 'application/octet-stream')
+      if data[:2] == b'\x1f\x8b':
+         out['Vary'] = 'Accept-Encoding'
+         if headers.get('accept-encoding','').find('gzip') != -1:
+            out['Content-Encoding'] = 'gzip'
+         else:
+            data = gzip.decompress(data)
+      return (200, out, bytes(data))
+
+   async def handle(self, reader, writer):
+      # one connection, kept open between requests unless asked not to
+      try:
+         while True:
+            try:
+               head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+               break
+            lines = head.decode('latin-1').split('\r\n')
+            request = lines[0].split(' ')
+            headers = {}
+            if len(request) != 3:
+               status, out, body = (400, {}, b'')
+               method, version = ('GET', 'HTTP/1.0')
+            else:
+               (method, path, version) = request
+               for line in lines[1:]:
+                  if ':' in line:
+                     (key, value) = line.split(':', 1)
+                     headers[key.strip().lower()] = value.strip()
+               status, out, body = await self.respond(method, path, headers)
+            keep = version == 'HTTP/1.1' and headers.get('connection','').lower() != 'close'
+            out['Content-Length'] = str(len(body))
+            out['Access-Control-Allow-Origin'] = '*'
+            out['Connection'] = 'keep-alive' if keep else 'close'
+            response = ['HTTP/1.1 %s %s'%(status, REASONS[status])]
+            for key in out:
+               response.append('%s: %s'%(key, out[key]))
+            writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+            if method != 'HEAD':
+               writer.write(body)
+            await writer.drain()
+            if not keep:
+               break
+      except ConnectionError:
+         pass
+      finally:
+         writer.close()
+
+   async def serve(self, host, port):
+      server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEAD)
+      print('Serving %s on http://%s:%s'%(', '.join(['%s (%s)'%(name,self.schemes[name]) for name in self.sources if name]),\
+            host,port))
+      async with server:
+         await server.serve_forever()
+
+def main():
+   args = parse_args()
+   for path in args.mbtiles:
+      if not os.path.isfile(path):
+         print('Failed to open %s -- Quitting'%path)
+         sys.exit(1)
+   server = TileServer(args.mbtiles, args.scheme, args.workers, args.cache * 1000000, args.immutable)
+   try:
+      asyncio.run(server.serve(args.host, args.port))
+   except KeyboardInterrupt:
+      pass
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Fetch each tile from the best of several WMTS mirrors, failing over to the others
+
+# Sources has the get(z, x, y) of wmts.WMTS, so TileFetcher and
+#   replace_tile use it unchanged. Each template is a Mirror, with its own
+#   WMTS (and so the host limiter of its host).
+# Every response is timed. Latency and error rate are moving averages (ALPHA),
+#   an error being an exception, a status other than 200 or 304, or a throttled
+#   response (fetch.is_throttled, which includes html in place of a tile).
+# Routing: a mirror whose error rate passes MAX_ERRORS rests for COOLDOWN
+#   seconds. A mirror not yet asked is tried first. Otherwise, of those within
+#   SLACK of the fastest, the one given first wins. One request in PROBE goes
+#   to the mirror timed the longest ago, to keep the averages current.
+# A tile that fails is asked of the next mirror, in the order given, until one
+#   returns it. With race, the best two are asked at once and the first good
+#   response is used.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fetch import is_throttled
+from wmts import WMTS
+
+ALPHA = 0.2
+MAX_ERRORS = 0.5
+COOLDOWN = 30.0
+SLACK = 1.5
+PROBE = 50
+
+def templates(gets, default):
+   # -g may be given several times, "." is the default source
+   if not gets:
+      return [default]
+   return [default if get == '.' else get for get in gets]
+
+class Mirror(object):
+
+   def __init__(self, template, priority, maxsize=10, rate=None):
+      self.template = template
+      self.priority = priority
+      self.wmts = WMTS(template, maxsize, rate)
+      self.latency = None # seconds
+      self.errors = 0.0
+      self.requests = 0
+      self.failures = 0
+      self.sampled = 0.0 # time.monotonic() of the last response
+      self.rest_until = 0.0
+
+   def healthy(self, now):
+      return now >= self.rest_until
+
+   def record(self, seconds, ok, now):
+      # called with the Sources lock held
+      self.requests += 1
+      self.sampled = now
+      if ok:
+         if self.latency is None:
+            self.latency = seconds
+         else:
+            self.latency += ALPHA * (seconds - self.latency)
+      else:
+         self.failures += 1
+      self.errors += ALPHA * ((0.0 if ok else 1.0) - self.errors)
+      if self.errors > MAX_ERRORS and self.requests >= 3:
+         self.rest_until = now + COOLDOWN
+         # back on trial after the rest
+         self.errors = MAX_ERRORS / 2
+
+class Sources(object):
+
+   def __init__(self, templates, maxsize=10, rate=None, race=False):
+      # templates are in order of preference
+      self.mirrors = [Mirror(template, priority, maxsize, rate) for (priority, template) in enumerate(templates)]
+      self.race = race and len(self.mirrors) > 1
+      if self.race:
+         self.pool = ThreadPoolExecutor(max_workers=maxsize * 2)
+      self.lock = threading.Lock()
+      self.count = 0
+
+   def ranked(self):
+      # mirrors in the order to try them for one tile
+      with self.lock:
+         now = time.monotonic()
+         self.count += 1
+         healthy = [mirror for mirror in self.mirrors if mirror.healthy(now)]
+         resting = [mirror for mirror in self.mirrors if not mirror.healthy(now)]
+         if not healthy:
+            return sorted(resting, key=lambda mirror: mirror.rest_until)
+         unasked = [mirror for mirror in healthy if mirror.requests == 0]
+         timed = [mirror for mirror in healthy if mirror.latency is not None]
+         if unasked:
+            first = unasked[0]
+         elif self.count % PROBE == 0 and len(healthy) > 1:
+            first = min(healthy, key=lambda mirror: mirror.sampled)
+         elif timed:
+            fastest = min([mirror.latency for mirror in timed])
+            first = [mirror for mirror in timed if mirror.latency <= fastest * SLACK][0]
+         else:
+            first = healthy[0]
+         return [first] + [mirror for mirror in healthy if mirror is not first] + resting
+
+   def ask(self, mirror, z, x, y, headers=None):
+      # returns (response, error, ok), and times it
+      start = time.monotonic()
+      response = None
+      error = None
+      try:
+         response = mirror.wmts.get(z, x, y, headers)
+         ok = response.status in (200, 304) and not is_throttled(response)
+      except Exception as e:
+         error = e
+         ok = False
+      now = time.monotonic()
+      with self.lock:
+         mirror.record(now - start, ok, now)
+      return (response, error, ok)
+
+   def get(self, z, x, y, headers=None):
+      # the first good response, else the last response any mirror gave,
+      #   else the last exception is raised
+      mirrors = self.ranked()
+      answers = []
+      if self.race:
+         pending = set([self.pool.submit(self.ask, mirror, z, x, y, headers) for mirror in mirrors[:2]])
+         mirrors = mirrors[2:]
+         while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+               answers.append(future.result())
+               if answers[-1][2]:
+                  return answers[-1][0]
+      for mirror in mirrors:
+         answers.append(self.ask(mirror, z, x, y, headers))
+         if answers[-1][2]:
+            return answers[-1][0]
+      responses = [response for (response, error, ok) in answers if response is not None]
+      if responses:
+         return responses[-1]
+      raise answers[-1][1]
+
+   def throttled(self):
+      # mirrors on one host share its limiter, it is counted once
+      limiters = dict([(id(mirror.wmts.limiter), mirror.wmts.limiter) for mirror in self.mirrors])
+      return sum([limiter.throttled for limiter in limiters.values()])
+
+   def report(self):
+      now = time.monotonic()
+      for mirror in self.mirrors:
+         latency = '%0.0fms'%(mirror.latency * 1000) if mirror.latency is not None else '-'
+         print('%s requests:%s failed:%s latency:%s errors:%0.2f%s'%(mirror.template[:60],\
+               mirror.requests,mirror.failures,latency,mirror.errors,\
+               '' if mirror.healthy(now) else ' resting'))
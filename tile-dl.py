@@ -12,18 +12,17 @@
 import sqlite3
 import sys, os
 import argparse
-import certifi
-import urllib3
 import tools
-import math
 from geojson import Feature, Point, FeatureCollection, Polygon
 import geojson
-from download import MBTiles, WMTS, fetch_quad_for
+from download import MBTiles
+from wmts import WMTS
+from fetch import TileFetcher, WORKERS
+import verify
+import sources
 import shutil
 import json
 import time
-import io 
-from PIL import Image
 #import ipdb; ipdb.set_trace()
 
 # GLOBALS
@@ -32,10 +31,10 @@ args = object
 earth_circum = 40075.0 # in km
 bbox_limits = {} # set by sat_bbox_limits, read by download
 src = object
+urls = [] # mirrors, in order of preference
 config = {}
 config_fn = 'config.json'
 total_tiles = 0
-bad_ref = 0
 
 ATTRIBUTION = os.environ.get('METADATA_ATTRIBUTION', '<a href="http://openmaptiles.org/" target="_blank">&copy; OpenMapTiles</a> <a href="http://www.openstreetmap.org/about/" target="_blank">&copy; OpenStreetMap contributors</a>')
 VERSION = os.environ.get('METADATA_VERSION', '3.3')
@@ -47,13 +46,18 @@ def parse_args():
     parser.add_argument('-z',"--zoom", help="zoom level", type=int)
     parser.add_argument("-m", "--mbtiles", help="mbtiles filename.")
     parser.add_argument("-v", "--verify", help="verify mbtiles.",action='store_true')
-    parser.add_argument("-f", "--fix", help="fix invalid tiles.",action='store_true')
+    parser.add_argument("-f", "--fix", help="fix invalid tiles, those queued by --verify.",action='store_true')
+    parser.add_argument("--check", help="How closely to check tiles, (Default=full for --verify, structure for downloads)",
+                        choices=verify.LEVELS)
+    parser.add_argument("-w", "--workers", help="Concurrent processes or downloads. (Default=%s)"%WORKERS, type=int, default=WORKERS)
     parser.add_argument("-n", "--name", help="Output filename.")
     parser.add_argument("--lat", help="Latitude degrees.",type=float)
     parser.add_argument("--lon", help="Longitude degrees.",type=float)
     parser.add_argument("-r","--radius", help="Download within this radius(km).",type=float)
     parser.add_argument("-t","--topzoom", help= 'Top Zoom',default=9,type=int)
-    parser.add_argument("-g", "--get", help='get WMTS tiles from this URL(Default: Sentinel Cloudless).')
+    parser.add_argument("-g", "--get", help='get WMTS tiles from this URL(Default: Sentinel Cloudless), repeat for mirrors in order of preference.',
+                        action='append')
+    parser.add_argument("--race", help="Ask the two best mirrors for each tile at once.",action="store_true")
     parser.add_argument("-s", "--summarize", help="Data about each zoom level.",action="store_true")
     return parser.parse_args()
 
@@ -171,7 +175,7 @@ def record_bbox_debug_info():
       fp.write(json.dumps(bbox_limits,indent=2))
 
 def get_degree_extent(lat_deg,lon_deg,radius_km,zoom=13):
-   (minX,maxX,minY,maxY) = bounds(lat_deg,lon_deg,radius_km,zoom)
+   (minX,maxX,minY,maxY) = region_bounds(lat_deg,lon_deg,radius_km,zoom)
    print('minX:%s,maxX:%s,minY:%s,maxY:%s'%(minX,maxX,minY,maxY))
    # following function returns (y,x)
    north_west_point = tools.xy2latlon(minX,minY,zoom)
@@ -182,11 +186,8 @@ def get_degree_extent(lat_deg,lon_deg,radius_km,zoom=13):
   
 
 def coordinates2WmtsTilesNumbers(lat_deg, lon_deg, zoom):
-  lat_rad = math.radians(lat_deg)
-  n = 2.0 ** zoom
-  xtile = int((lon_deg + 180.0) / 360.0 * n)
-  ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-  return (xtile, ytile)
+  x,y = tools.tileXYArray(lat_deg,lon_deg,zoom)
+  return (int(x), int(y))
 
 def sat_bbox(lat_deg,lon_deg,zoom,radius):
    # Adds a bounding box for the current location, radius
@@ -219,66 +220,47 @@ def sat_bbox(lat_deg,lon_deg,zoom,radius):
 
 def create_clone():
    global mbTiles
-   global bad_ref
    global src
    # Open a WMTS source
    try:
-      src = WMTS(url)
+      src = sources.Sources(urls,maxsize=args.workers,race=args.race)
    except:
       print('failed to open WMTS source in scan_verify')
       sys.exit(1)
    
    # copy the source into a work directory, then do in place substitution
    set_up_target_db('fix_try')
-   bad_ref = open('./work/bad_tiles','w')
+   return mbTiles.writer().open()
 
 
 def scan_verify():
-   global src # the opened url for satellite images
-   if args.fix:
-      create_clone()
-   replaced = bad = ok = empty = html = unfixable = 0
-   mbTiles = MBTiles(args.mbtiles)
+   # decoding is spread over processes, bad tiles are queued for fix_tiles
    print('Opening database %s'%args.mbtiles)
-   for zoom in sorted(bounds.keys()):
-      #if zoom == 5: sys.exit()
-      bad = ok = empty = html = 0
-      for tileY in range(bounds[zoom]['minY'],bounds[zoom]['maxY'] + 1):
-         #print("New Y:%s on zoom:%s"%(tileY,zoom))
-         for tileX in range(bounds[zoom]['minX'],bounds[zoom]['maxX'] + 1):
-               #print('tileX:%s'%tileX)
-               replace = False
-               raw = mbTiles.GetTile(zoom, tileX, tileY)
-               try:
-                  image = Image.open(io.BytesIO(raw))
-
-                  ok += 1
-                  if len(raw) < 800: 
-                     replace=True
-                  else:
-                     continue
-               except Exception as e:
-                  bad += 1
-                  replace = True
-                  line = bytearray(raw)
-                  if line.find("DOCTYPE") != -1:
-                     html +=1
-                  if args.fix and replace:
-                        success = replace_tile(src,zoom,tileX,tileY)
-                        if success:
-                           bad_ref.write('%s,%s,%s\n'%(zoom,tileX,tileY))
-                           replaced += 1
-                        else:
-                           bad_ref.write('%s,%s,%s\n'%(zoom,tileX,tileY))
-                           unfixable += 1
-                        if tileY % 20 == 0:
-                           print('replaced:%s  ok:%s'%(replaced,ok))
-      print('bad',bad,'ok',ok, 'empty',empty,'html',html, 'unfixable',unfixable,'zoom',zoom,'replaced',replaced)
-   print('bad',bad,'ok',ok, 'empty',empty,'html',html, 'unfixable',unfixable)
+   verify.scan(args.mbtiles, args.workers, queue=verify.QUEUE, level=args.check or 'full')
    if args.fix:
-      bad_ref.close()
+      fix_tiles()
+
+def fix_tiles():
+   # fetch again, concurrently, the tiles that scan_verify queued
+   writer = create_clone()
+   counts = { 'replaced': 0, 'unfixable': 0 }
+   with open('./work/unfixable_tiles','w') as unfixable_fp:
+      def fixed(zoom, tileX, tileY, r, error):
+         if not error and r.status == 200 and verify.classify(r.data, args.check or 'structure') in verify.GOOD:
+            writer.put(zoom, tileX, tileY, r.data)
+            counts['replaced'] += 1
+         else:
+            unfixable_fp.write('%s,%s,%s\n'%(zoom,tileX,tileY))
+            counts['unfixable'] += 1
+         if (counts['replaced'] + counts['unfixable']) % 20 == 0:
+            print('replaced:%s  unfixable:%s'%(counts['replaced'],counts['unfixable']))
+      TileFetcher(src,workers=args.workers).run(verify.read_queue(verify.QUEUE),fixed)
+   writer.close()
+   print('replaced:%s  unfixable:%s'%(counts['replaced'],counts['unfixable']))
+   src.report()
    
-def replace_tile(src,zoom,tileX,tileY):
+def replace_tile(src,zoom,tileX,tileY,writer=None):
+   # with a writer the tile is batched, and read verify is skipped
    global total_tiles
    try:
       r = src.get(zoom,tileX,tileY)
@@ -287,18 +269,17 @@ def replace_tile(src,zoom,tileX,tileY):
       sys.exit(1)
    if r.status == 200:
       raw = r.data
-      line = bytearray(raw)
-      if line.find("DOCTYPE") != -1:
+      result = verify.classify(raw, args.check or 'structure')
+      if result == 'html':
          print('still getting html from sentinel cloudless')
          return False
+      elif result not in verify.GOOD:
+         print('%s tile from source, zoom:%s X:%s Y:%s'%(result,zoom,tileX,tileY))
+         return False
       else:
-         try:
-            image = Image.open(StringIO.StringIO(raw))
-            #image.show(StringIO.StringIO(raw))
-         except Exception as e:
-            print('exception:%s'%e)
-            sys.exit()
-         #raw_input("PRESS ENTER")
+         if writer:
+            writer.put(zoom, tileX, tileY, r.data)
+            return True
          mbTiles.SetTile(zoom, tileX, tileY, r.data)
          returned = mbTiles.GetTile(zoom, tileX, tileY)
          if bytearray(returned) != r.data:
@@ -309,14 +290,14 @@ def replace_tile(src,zoom,tileX,tileY):
       print('get url in replace_tile returned:%s'%r.status)
       return False
 
-def download_tiles(src,lat_deg,lon_deg,zoom,radius):
+def download_tiles(src,lat_deg,lon_deg,zoom,radius,writer=None):
    global mbTiles
    global total_tiles
    tileX_min,tileX_max,tileY_min,tileY_max = mbtile_limits(zoom)
    for tileX in range(tileX_min,tileX_max+1):
       for tileY in range(tileY_min,tileY_max+1):
          print('tileX:%s tileY:%s'%(tileX,tileY))
-         replace_tile(src,zoom,tileX,tileY)
+         replace_tile(src,zoom,tileX,tileY,writer)
 
 def set_up_target_db(name='sentinel'):
    global mbTiles
@@ -332,7 +313,6 @@ def set_up_target_db(name='sentinel'):
       shutil.copyfile('./satellite.mbtiles',dbpath) 
    mbTiles = MBTiles(dbpath)
    mbTiles.CheckSchema()
-   mbTiles.get_bounds()
    config['last_db'] = dbpath
    put_config()
    print("Destination Database opened successfully:%s"%dbpath)
@@ -341,22 +321,23 @@ def do_downloads():
    # Open a WMTS source
    global src # the opened url for satellite images
    try:
-      src = WMTS(url)
+      src = sources.Sources(urls,race=args.race)
    except:
       print('failed to open source')
       sys.exit(1)
    set_up_target_db(args.name)
    start = time.time()
-   for zoom in range(args.zoom,args.topzoom):
-      print("new zoom level:%s"%zoom)
-      download_tiles(src,args.lat,args.lon,zoom,args.radius)
+   with mbTiles.writer() as writer:
+      for zoom in range(args.zoom,args.topzoom):
+         print("new zoom level:%s"%zoom)
+         download_tiles(src,args.lat,args.lon,zoom,args.radius,writer)
    print('Total time:%s Total_tiles:%s'%(time.time()-start,total_tiles))
 
 def main():
    global args
    global mbTiles
    global url
-   global bounds
+   global urls
    args = parse_args()
    # Default to standard source
    if not os.path.isdir('./work'):
@@ -367,23 +348,25 @@ def main():
       else:
          args.mbtiles = './satellite.mbtiles'
    print('mbtiles SOURCE filename:%s'%args.mbtiles)
-   if os.path.isfile(args.mbtiles):
-      mbTiles  = MBTiles(args.mbtiles)
-      bounds = mbTiles.get_bounds()
-   else:
+   # the database is opened by the commands that use it
+   if not os.path.isfile(args.mbtiles):
       print('Failed to open %s -- Quitting'%args.mbtiles)
       sys.exit()
+   url =  "https://tiles.maps.eox.at/wmts?layer=s2cloudless-2018_3857&style=default&tilematrixset=g&Service=WMTS&Request=GetTile&Version=1.0.0&Format=image%2Fjpeg&TileMatrix={z}&TileCol={x}&TileRow={y}"
    if  args.get != None:
       print('get specified')
-      url = args.get
-   else:
-      url =  "https://tiles.maps.eox.at/wmts?layer=s2cloudless-2018_3857&style=default&tilematrixset=g&Service=WMTS&Request=GetTile&Version=1.0.0&Format=image%2Fjpeg&TileMatrix={z}&TileCol={x}&TileRow={y}"
+   urls = sources.templates(args.get, url)
+   url = urls[0]
    if args.summarize:
+      mbTiles = MBTiles(args.mbtiles)
       mbTiles.summarize()
       sys.exit(0)
    if args.verify:
       scan_verify()
       sys.exit(0)
+   if args.fix:
+      fix_tiles()
+      sys.exit(0)
    if not args.lon and not args.lat:
       args.lon = -122.14 
       args.lat = 37.46
@@ -8,6 +8,10 @@
 # This file is public-domain
 #-------------------------------------------------------
 from math import *
+import numpy as np
+
+# Web mercator stops here, the poles map to infinity
+MAX_LAT = degrees(atan(sinh(pi)))
 
 def numTiles(z):
   return(pow(2,z))
@@ -60,6 +64,47 @@ def tileEdges(x,y,z):
 def mercatorToLat(mercatorY):
   return(degrees(atan(sinh(mercatorY))))
 
+#-------------------------------------------------------
+# Batch versions of the above, on numpy arrays
+#   Arguments broadcast against each other, so many points can be done for
+#   many zooms in one call, eg. lats[:,None] with zooms[None,:].
+#   Latitudes are clamped to +-MAX_LAT, longitudes to -180..180, and tile
+#   numbers to 0..2**z-1, so a pole or the dateline gives the edge tile.
+
+def latlon2xyArray(lat,lon,z):
+  lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT))
+  lon = np.clip(np.asarray(lon, dtype=np.float64), -180.0, 180.0)
+  n = np.exp2(np.asarray(z, dtype=np.float64))
+  x = (lon + 180.0) / 360.0 * n
+  y = (1.0 - np.arcsinh(np.tan(lat)) / pi) / 2.0 * n
+  return(x,y)
+
+def tileXYArray(lat,lon,z):
+  x,y = latlon2xyArray(lat,lon,z)
+  top = np.exp2(np.asarray(z)).astype(np.int64) - 1
+  x = np.clip(np.floor(x).astype(np.int64), 0, top)
+  y = np.clip(np.floor(y).astype(np.int64), 0, top)
+  return(x,y)
+
+def xy2latlonArray(x,y,z):
+  n = np.exp2(np.asarray(z, dtype=np.float64))
+  relY = np.asarray(y, dtype=np.float64) / n
+  lat = np.degrees(np.arctan(np.sinh(pi * (1 - 2 * relY))))
+  lon = -180.0 + 360.0 * np.asarray(x, dtype=np.float64) / n
+  return(lat,lon)
+
+def tileEdgesArray(x,y,z):
+  north,west = xy2latlonArray(x,y,z)
+  south,east = xy2latlonArray(np.asarray(x) + 1,np.asarray(y) + 1,z)
+  return((south, west, north, east)) # S,W,N,E
+
+def bboxTileLimits(west,south,east,north,z):
+  # tiles covering the boxes, (xmin,xmax,ymin,ymax) with xmax and ymax
+  #   one past the last tile, as download.bbox_tile_limits returns them
+  xmin,ymax = tileXYArray(south,west,z)
+  xmax,ymin = tileXYArray(north,east,z)
+  return(xmin,xmax+1,ymin,ymax+1)
+
 def tileSizePixels():
   return(256)
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Recompress the images of an mbtiles as jpeg or webp, to make the file smaller
+
+# Images are read in rowid order, a page at a time, up to the last rowid that
+#   was there at the start, so the images written meanwhile are not read again.
+#   Pages are recompressed in a pool of processes, a bounded number at once.
+# A new encoding is kept only if it is smaller than the old one. It is stored
+#   under its own content hash (wmts.tile_hash), the map rows are pointed
+#   at it, and the old image is deleted once nothing uses it, as Dedupe does.
+# Images already in the format are left alone, so a run again only does
+#   what the last one did not. So are images with transparency when the
+#   output is jpeg, and vector (pbf) tiles always.
+# Sizes per zoom are the bytes of the tiles at that zoom, before and after,
+#   counting a shared image once per tile. The file is vacuumed at the end.
+# The format in metadata is changed only when no image is left in another
+#   format, those whose new encoding was not smaller included.
+
+import os, sys
+import argparse
+import sqlite3
+import time
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+import download
+from wmts import tile_hash
+import verify
+from plan import human_bytes
+
+FORMATS = { 'jpeg': 'JPEG', 'webp': 'WEBP' }
+# what the metadata table calls them, as set_metadata in importer.py
+METADATA_FORMATS = { 'jpeg': 'jpg', 'webp': 'webp' }
+SOURCES = ('jpeg', 'png', 'webp')
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Recompress the images of an mbtiles.")
+   parser.add_argument("mbtiles", help="mbtiles filename.")
+   parser.add_argument("-f", "--format", help="Format to recompress to. (Default=jpeg)",
+                       choices=sorted(FORMATS), default='jpeg')
+   parser.add_argument("-q", "--quality", help="jpeg or webp quality. (Default=75)", type=int, default=75)
+   parser.add_argument("-w", "--workers", help="Processes. (Default=cpu count)", type=int)
+   return parser.parse_args()
+
+def transcode(data, fmt='jpeg', quality=75):
+   # returns the new encoding, or None if it is not smaller, cannot be made,
+   #   or the image is already in fmt
+   kind = verify.image_format(data)
+   if kind not in SOURCES or kind == fmt:
+      return None
+   try:
+      image = Image.open(BytesIO(data))
+      image.load()
+   except Exception:
+      return None
+   alpha = 'A' in image.mode or 'transparency' in image.info
+   if fmt == 'jpeg':
+      if alpha:
+         return None
+      image = image.convert('RGB')
+   elif image.mode not in ('RGB', 'RGBA'):
+      image = image.convert('RGBA' if alpha else 'RGB')
+   out = BytesIO()
+   if fmt == 'jpeg':
+      image.save(out, FORMATS[fmt], quality=quality, optimize=True)
+   else:
+      image.save(out, FORMATS[fmt], quality=quality)
+   if out.tell() >= len(data):
+      return None
+   return out.getvalue()
+
+def transcode_chunk(chunk, fmt, quality):
+   # runs in a worker process, chunk is [(tile_id, tile_data)], returns
+   #   ([(old tile_id, new tile_id, new tile_data)], number left alone,
+   #   number of those left in another format than fmt)
+   changed = []
+   other = 0
+   for (tile_id, data) in chunk:
+      new = transcode(data, fmt, quality)
+      if new:
+         changed.append((tile_id, tile_hash(new), new))
+      elif verify.image_format(data) != fmt:
+         other += 1
+   return (changed, len(chunk) - len(changed), other)
+
+def pages(mbTiles, size):
+   # yields lists of (tile_id, tile_data), none written after the start
+   last = mbTiles.c.execute('SELECT max(rowid) FROM images').fetchone()[0] or 0
+   sql = 'SELECT rowid, tile_id, tile_data FROM images WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?'
+   rowid = 0
+   while True:
+      rows = mbTiles.c.execute(sql, (rowid, last, size)).fetchall()
+      if not rows:
+         return
+      rowid = rows[-1][0]
+      yield [(row[1], bytes(row[2])) for row in rows]
+
+def replace_images(mbTiles, changed):
+   # changed is [(old tile_id, new tile_id, new tile_data)], one transaction
+   if not changed:
+      return
+   with mbTiles.conn:
+      mbTiles.c.executemany('INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)',
+            [(sqlite3.Binary(new), new_id) for (old_id, new_id, new) in changed])
+      mbTiles.c.executemany('UPDATE map SET tile_id = ? WHERE tile_id = ?',
+            [(new_id, old_id) for (old_id, new_id, new) in changed if new_id != old_id])
+      mbTiles.c.executemany('''DELETE FROM images WHERE tile_id = ?
+            AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id)''',
+            [(old_id,) for (old_id, new_id, new) in changed if new_id != old_id])
+   print('+',flush=True,end="")
+
+def zoom_sizes(mbTiles):
+   # {zoom: (tiles, bytes)}
+   sql = '''SELECT map.zoom_level, count(*), sum(length(images.tile_data)) FROM map
+            JOIN images ON images.tile_id = map.tile_id GROUP BY map.zoom_level'''
+   return dict([(row[0], (row[1], row[2] or 0)) for row in mbTiles.c.execute(sql)])
+
+def report(before, after, file_before, file_after):
+   print('%5s %12s %10s %10s %7s'%('ZOOM','TILES','BEFORE','AFTER','SAVED'))
+   total = [0, 0, 0]
+   for zoom in sorted(before):
+      (tiles, old) = before[zoom]
+      new = after.get(zoom, (0, 0))[1]
+      print('%5s %12s %10s %10s %6.1f%%'%(zoom,tiles,human_bytes(old),human_bytes(new),\
+            100.0 * (old - new) / max(old, 1)))
+      total = [total[0] + tiles, total[1] + old, total[2] + new]
+   print('%5s %12s %10s %10s %6.1f%%'%('ALL',total[0],human_bytes(total[1]),human_bytes(total[2]),\
+         100.0 * (total[1] - total[2]) / max(total[1], 1)))
+   print('File %s -> %s'%(human_bytes(file_before),human_bytes(file_after)))
+
+def transcode_file(mbTiles, fmt='jpeg', quality=75, workers=None):
+   workers = workers or os.cpu_count()
+   start = time.time()
+   file_before = os.path.getsize(mbTiles.filename)
+   before = zoom_sizes(mbTiles)
+   counts = { 'changed': 0, 'kept': 0, 'other': 0 }
+   changed = []
+   pending = set()
+
+   def drain(pending, changed):
+      finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in finished:
+         (done, kept, other) = future.result()
+         counts['changed'] += len(done)
+         counts['kept'] += kept
+         counts['other'] += other
+         changed += done
+      if len(changed) >= download.BATCH_SIZE:
+         replace_images(mbTiles, changed)
+         changed = []
+      return (pending, changed)
+
+   saved_pragmas = mbTiles.SetPragmas(download.WRITER_PRAGMAS)
+   with ProcessPoolExecutor(max_workers=workers) as pool:
+      for page in pages(mbTiles, verify.CHUNK):
+         pending.add(pool.submit(transcode_chunk, page, fmt, quality))
+         while len(pending) >= workers * 2:
+            pending, changed = drain(pending, changed)
+      while len(pending) > 0:
+         pending, changed = drain(pending, changed)
+   replace_images(mbTiles, changed)
+   # format describes every image, a file left mixed keeps the one it had
+   if counts['changed'] and not counts['other']:
+      mbTiles.SetMetaData('format', METADATA_FORMATS[fmt])
+   elif counts['other']:
+      print('\n%s images are still not %s, format left as it was'%(counts['other'],fmt))
+   mbTiles.SetPragmas(saved_pragmas)
+   mbTiles.c.execute('vacuum')
+   print('\nRecompressed %s images as %s quality %s, %s left as they were, in %0.1f seconds'%(\
+         counts['changed'],fmt,quality,counts['kept'],time.time()-start))
+   report(before, zoom_sizes(mbTiles), file_before, os.path.getsize(mbTiles.filename))
+   return counts
+
+def main():
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('Failed to open %s -- Quitting'%args.mbtiles)
+      sys.exit(1)
+   mbTiles = download.MBTiles(args.mbtiles)
+   mbTiles.CheckSchema()
+   transcode_file(mbTiles, args.format, args.quality, args.workers)
+
+if __name__ == "__main__":
+   main()
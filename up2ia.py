@@ -16,8 +16,8 @@ import shutil
 import subprocess
 import internetarchive
 from datetime import datetime
-import urllib3
-import certifi
+import httpclient
+import checksum
 
 MAP_DATE = '2020-01-13'
 CATALOG = './map-catalog.json'
@@ -28,6 +28,9 @@ DOWNLOAD_URL = 'https://archive.org/download'
 PREFIX = '/hd/maps/maps-2020/staged'
 
 def process_catalog_list(group):
+   # hashed in parallel up front, files unchanged since the last run are not read
+   local = [PREFIX + '/' + mbtile for mbtile in data[group].keys() if os.path.exists(PREFIX + '/' + mbtile)]
+   hashes = checksum.checksum(local)
    for mbtile in data[group].keys():
       if True:
          print(mbtile)
@@ -35,8 +38,7 @@ def process_catalog_list(group):
              print('Local file %s not found.'%(PREFIX + '/' + mbtile))
          else:
              src = SOURCE_URL_DIR + '/' + mbtile
-             pool = urllib3.PoolManager()
-             s = pool.request("GET",src,preload_content=False)
+             s = http.request("HEAD",src)
              if s.status == 200:
                 # print("length:%s"%s.headers['Content-Length'])
                 if int(s.headers['Content-Length']) != data[group][mbtile]['size']:
@@ -44,13 +46,11 @@ def process_catalog_list(group):
              else:
                 print("Failed to open %s"%src) 
 
-         # Fetch the md5 to see if local file needs uploading
+         # The md5 tells if local file needs uploading
          local_mbtile = PREFIX + '/' + mbtile
-         with open(local_mbtile + '.md5','r') as md5_fp:
-            instr = md5_fp.read()
-            md5 = instr.split(' ')[0]
+         md5 = hashes.get(local_mbtile,{}).get('md5','')
          if len(md5) == 0:
-            print('md5 was zero length. ABORTING')
+            print('No md5 for %s. ABORTING'%local_mbtile)
             sys.exit(1)
 
          perma_ref = 'en-osm-omt_' + data[group][mbtile]['region']
@@ -105,12 +105,12 @@ def process_catalog_list(group):
            
 
 outstr = ''
-http = urllib3.PoolManager()
-r = http.request("get",CATALOG_URL,headers={"Accept":"*/*"})
+http = httpclient.shared()
+r = http.request("GET",CATALOG_URL,headers={"Accept":"*/*"})
 if r.status < 400:
     data = json.loads(r.data)
 else:
-    print('Failed to open %s Status:%s'%(CATALOG_URL,r.status_code))
+    print('Failed to open %s Status:%s'%(CATALOG_URL,r.status))
     sys.exit(1)
    
 process_catalog_list('maps')
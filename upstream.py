@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Keep the ETag and Last-Modified of each downloaded tile, to ask for it again conditionally
+
+# The "upstream" table has a row per tile fetched: its validators, as the
+#   source sent them, the tile_hash of the bytes it sent, and when it was
+#   last checked (unix seconds). The hash is of what came from the source,
+#   not of the stored image, which a flat tile, transcode.py or an older
+#   file's random tile_id make differ from it. Rows are
+#   written without a commit, so they go in with the writer's next batch, and
+#   are never committed ahead of the tile they describe.
+# A refresh of a zoom asks again for every tile of the file not checked since
+#   the refresh started, with If-None-Match and If-Modified-Since. The start is
+#   kept in satdata as 'refresh' until the zoom is finished, so a refresh that
+#   is stopped carries on where the last committed batch left it.
+# Tiles are read a page at a time in map_index order, each page starting past
+#   the last tile of the one before.
+
+import time
+from wmts import tile_hash
+
+PAGE = 1000
+
+class Validators(object):
+
+   def __init__(self, mbtiles):
+      self.mbtiles = mbtiles
+      sql = '''CREATE TABLE IF NOT EXISTS upstream (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,
+               etag TEXT,modified TEXT,checked INTEGER,hash TEXT)'''
+      self.mbtiles.c.execute(sql)
+      columns = [row[1] for row in self.mbtiles.c.execute('PRAGMA table_info(upstream)').fetchall()]
+      if 'hash' not in columns:
+         self.mbtiles.c.execute('ALTER TABLE upstream ADD COLUMN hash TEXT')
+      sql = 'CREATE UNIQUE INDEX IF NOT EXISTS upstream_index ON upstream (zoom_level,tile_column,tile_row)'
+      self.mbtiles.c.execute(sql)
+      self.mbtiles.Commit()
+      self.hashes = {} # (zoom, x, y) -> upstream hash, of the tiles handed out by unchecked()
+
+   def add(self, zoom, tileX, tileY, response):
+      # the validators of a 200 or 304, a 304 may leave them out and has no body
+      etag = response.headers.get('ETag')
+      modified = response.headers.get('Last-Modified')
+      upstream = tile_hash(response.data) if response.status == 200 else None
+      self.mbtiles.c.execute('''INSERT INTO upstream (zoom_level, tile_column, tile_row, etag, modified, checked, hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET
+            etag = coalesce(excluded.etag, etag), modified = coalesce(excluded.modified, modified),
+            checked = excluded.checked, hash = coalesce(excluded.hash, hash)''',
+            (zoom, tileX, tileY, etag, modified, int(time.time()), upstream))
+
+   def started(self, zoom):
+      # when the refresh of this zoom began, now if it is not under way
+      data = self.mbtiles.GetSatMetaData(zoom)
+      if 'refresh' in data:
+         return int(data['refresh'])
+      since = int(time.time())
+      self.mbtiles.SetSatMetaData(zoom, 'refresh', str(since))
+      return since
+
+   def finished(self, zoom):
+      self.mbtiles.DeleteSatData(zoom, 'refresh')
+
+   def unchecked(self, zoom, since):
+      # yields (zoom, x, y, headers) for the tiles not checked since then
+      sql = '''SELECT map.tile_column, map.tile_row, upstream.hash, upstream.etag, upstream.modified FROM map
+               LEFT JOIN upstream ON upstream.zoom_level = map.zoom_level
+               AND upstream.tile_column = map.tile_column AND upstream.tile_row = map.tile_row
+               WHERE map.zoom_level = ? AND (map.tile_column, map.tile_row) > (?, ?)
+               AND (upstream.checked IS NULL OR upstream.checked <= ?)
+               ORDER BY map.tile_column, map.tile_row LIMIT ?'''
+      last = (-1, -1)
+      while True:
+         rows = self.mbtiles.c.execute(sql, (zoom, last[0], last[1], since, PAGE)).fetchall()
+         if not rows:
+            return
+         last = (rows[-1][0], rows[-1][1])
+         for row in rows:
+            headers = {}
+            if row[3]:
+               headers['If-None-Match'] = row[3]
+            if row[4]:
+               headers['If-Modified-Since'] = row[4]
+            self.hashes[(zoom, row[0], row[1])] = row[2]
+            yield (zoom, row[0], row[1], headers)
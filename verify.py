@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# Check every image in an mbtiles with a pool of processes, report per zoom
+
+# Images are read in rowid order through one cursor, which is the order they
+#   lie in the file, and handed to worker processes in chunks. Each image is
+#   decoded once, however many tiles share it. Only the bad ones come back.
+#   Their tiles, and those whose image is missing, are found in one pass over
+#   map, looking each image up in images_index. A file without that index is
+#   checked against the tile_ids read from images, held in memory instead.
+# Classes:
+#   ok          -- decodes
+#   truncated   -- image data ends early
+#   html        -- an error page stored in place of the tile
+#   tiny        -- decodes, but too small to be real imagery
+#   undecodable -- anything else that PIL rejects, or no data at all
+#   missing     -- a map row whose image is not in images
+# Levels, cheapest first:
+#   header      -- magic bytes of jpeg, png, webp or pbf
+#   structure   -- end markers, and the dimensions the header declares
+#   full        -- decode the image with PIL (pbf is decompressed and walked)
+#   Downloads use structure by default, it does not decode, and --verify full.
+# The report is json. The bad tiles, but for the GOOD ones (tiny), are also
+#   written one "zoom,x,y" per line, the queue that tile-dl.py --fix reads to
+#   fetch them again.
+
+import os, sys
+import argparse
+import json
+import sqlite3
+import time
+import urllib.parse
+import gzip
+import struct
+import zlib
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+
+CLASSES = ('ok','truncated','html','tiny','undecodable','missing')
+LEVELS = ('header','structure','full')
+# classes a freshly downloaded tile may have, small tiles are often plain sea
+GOOD = ('ok','tiny')
+# largest width or height believed in a header
+MAX_SIZE = 4096
+# decoded tiles smaller than this are suspect, as in the old scan_verify
+TINY = 800
+CHUNK = 256
+REPORT = './work/verify.json'
+QUEUE = './work/bad_tiles'
+
+def image_format(data):
+   # from the magic bytes, None if it is none of the tile formats
+   if data[:3] == b'\xff\xd8\xff':
+      return 'jpeg'
+   if data[:8] == b'\x89PNG\r\n\x1a\n':
+      return 'png'
+   if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+      return 'webp'
+   if data[:2] == b'\x1f\x8b' or data[:1] == b'\x1a':
+      return 'pbf'
+   return None
+
+def jpeg_structure(data):
+   # walk the segments up to the frame header, which holds the dimensions
+   if data[-32:].find(b'\xff\xd9') == -1:
+      return ('truncated', None)
+   i = 2
+   while i + 4 <= len(data):
+      if data[i] != 0xff:
+         return ('undecodable', None)
+      marker = data[i+1]
+      if marker == 0xff:
+         i += 1
+         continue
+      if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+         i += 2
+         continue
+      length = struct.unpack('>H', data[i+2:i+4])[0]
+      if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+         if i + 9 > len(data):
+            return ('truncated', None)
+         (height, width) = struct.unpack('>HH', data[i+5:i+9])
+         return ('ok', (width, height))
+      if marker == 0xda:
+         break
+      i += 2 + length
+   return ('truncated', None)
+
+def png_structure(data):
+   if len(data) < 33 or data[12:16] != b'IHDR':
+      return ('truncated', None)
+   if data[-8:-4] != b'IEND':
+      return ('truncated', None)
+   return ('ok', struct.unpack('>II', data[16:24]))
+
+def webp_structure(data):
+   if struct.unpack('<I', data[4:8])[0] + 8 > len(data):
+      return ('truncated', None)
+   chunk = data[12:16]
+   if chunk == b'VP8 ' and len(data) >= 30:
+      (width, height) = struct.unpack('<HH', data[26:30])
+      return ('ok', (width & 0x3fff, height & 0x3fff))
+   if chunk == b'VP8L' and len(data) >= 25:
+      bits = struct.unpack('<I', data[21:25])[0]
+      return ('ok', ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1))
+   if chunk == b'VP8X' and len(data) >= 30:
+      width = int.from_bytes(data[24:27], 'little') + 1
+      height = int.from_bytes(data[27:30], 'little') + 1
+      return ('ok', (width, height))
+   return ('undecodable', None)
+
+def pbf_structure(data):
+   # gzip is only checked for its trailer here, plain protobuf is walked:
+   #   every top level field must end exactly at the end of the tile
+   if data[:2] == b'\x1f\x8b':
+      if len(data) < 18:
+         return ('truncated', None)
+      return ('ok', None)
+   i = 0
+   while i < len(data):
+      (key, i) = varint(data, i)
+      if key is None:
+         return ('truncated', None)
+      wire = key & 7
+      if wire == 0:
+         (value, i) = varint(data, i)
+         if value is None:
+            return ('truncated', None)
+      elif wire == 1:
+         i += 8
+      elif wire == 2:
+         (length, i) = varint(data, i)
+         if length is None:
+            return ('truncated', None)
+         i += length
+      elif wire == 5:
+         i += 4
+      else:
+         return ('undecodable', None)
+   if i > len(data):
+      return ('truncated', None)
+   return ('ok', None)
+
+def varint(data, i):
+   # returns (value, next index), value is None if the data ends first
+   value = 0
+   shift = 0
+   while i < len(data):
+      byte = data[i]
+      value |= (byte & 0x7f) << shift
+      i += 1
+      if not byte & 0x80:
+         return (value, i)
+      shift += 7
+   return (None, i)
+
+STRUCTURE = { 'jpeg': jpeg_structure, 'png': png_structure, 'webp': webp_structure,
+              'pbf': pbf_structure }
+
+def decode(data, kind):
+   if kind == 'pbf':
+      try:
+         if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+      except (OSError, EOFError, zlib.error) as e:
+         if str(e).find('end') != -1:
+            return 'truncated'
+         return 'undecodable'
+      return pbf_structure(data)[0]
+   try:
+      image = Image.open(BytesIO(data))
+      image.load()
+   except OSError as e:
+      if str(e).find('truncated') != -1:
+         return 'truncated'
+      return 'undecodable'
+   except Exception:
+      return 'undecodable'
+   return 'ok'
+
+def classify(data, level='full'):
+   # level is one of LEVELS, each one does the checks of those before it
+   if data is None:
+      return 'undecodable' # a NULL tile_data
+   data = bytes(data)
+   if data[:512].find(b"DOCTYPE") != -1 or data[:512].lower().find(b"<html") != -1:
+      return 'html'
+   kind = image_format(data)
+   if kind is None:
+      return 'undecodable'
+   if level != 'header':
+      (result, size) = STRUCTURE[kind](data)
+      if result != 'ok':
+         return result
+      if size is not None and (size[0] == 0 or size[1] == 0 or size[0] > MAX_SIZE or size[1] > MAX_SIZE):
+         return 'undecodable'
+   if level == 'full':
+      result = decode(data, kind)
+      if result != 'ok':
+         return result
+   if len(data) < TINY:
+      return 'tiny'
+   return 'ok'
+
+def classify_chunk(chunk, level='full'):
+   # runs in a worker process, returns (number ok, [(tile_id, class),..])
+   ok = 0
+   bad = []
+   for (tile_id, data) in chunk:
+      result = classify(data, level)
+      if result == 'ok':
+         ok += 1
+      else:
+         bad.append((tile_id, result))
+   return (ok, bad)
+
+def read_chunks(conn, tile_ids=None):
+   # tile_ids, if given, gets every image's tile_id on the way
+   chunk = []
+   for row in conn.execute('SELECT tile_id, tile_data FROM images ORDER BY rowid'):
+      chunk.append((row[0], row[1]))
+      if tile_ids is not None:
+         tile_ids.add(row[0])
+      if len(chunk) >= CHUNK:
+         yield chunk
+         chunk = []
+   if chunk:
+      yield chunk
+
+def has_index(conn, table, column):
+   # an index whose first column is column
+   for index in conn.execute('PRAGMA index_list(%s)'%table).fetchall():
+      info = conn.execute('PRAGMA index_info("%s")'%index[1]).fetchall()
+      if info and info[0][2] == column:
+         return True
+   return False
+
+def scan(path, workers=None, report=REPORT, queue=QUEUE, level='full'):
+   conn = sqlite3.connect('file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(path)), uri=True)
+   workers = workers or os.cpu_count()
+   start = time.time()
+   images_ok = 0
+   bad_images = {}
+   # with images_index each map row looks its image up, else the tile_ids
+   #   are kept as they are read, which costs memory on large files
+   indexed = has_index(conn, 'images', 'tile_id')
+   tile_ids = None if indexed else set()
+   pending = set()
+   with ProcessPoolExecutor(max_workers=workers) as pool:
+      for chunk in read_chunks(conn, tile_ids):
+         pending.add(pool.submit(classify_chunk, chunk, level))
+         while len(pending) >= workers * 2:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+               ok, bad = future.result()
+               images_ok += ok
+               bad_images.update(bad)
+      for future in pending:
+         ok, bad = future.result()
+         images_ok += ok
+         bad_images.update(bad)
+   print('Images ok:%s bad:%s in %0.1f seconds, %s check'%(images_ok,len(bad_images),time.time()-start,level))
+
+   # one pass over map, against images_index or the tile_ids seen in images
+   zooms = {}
+   bad_tiles = []
+   if indexed:
+      sql = '''SELECT zoom_level, tile_column, tile_row, tile_id,
+            EXISTS (SELECT 1 FROM images WHERE images.tile_id = map.tile_id) FROM map'''
+   else:
+      sql = 'SELECT zoom_level, tile_column, tile_row, tile_id, NULL FROM map'
+   for row in conn.execute(sql):
+      if row[0] not in zooms:
+         zooms[row[0]] = dict([(name, 0) for name in CLASSES])
+         zooms[row[0]]['total'] = 0
+      zooms[row[0]]['total'] += 1
+      if not (row[4] if indexed else row[3] in tile_ids):
+         result = 'missing'
+      else:
+         result = bad_images.get(row[3], 'ok')
+      zooms[row[0]][result] += 1
+      if result != 'ok':
+         bad_tiles.append((row[0], row[1], row[2], result))
+   conn.close()
+
+   totals = dict([(name, 0) for name in CLASSES + ('total',)])
+   for zoom in sorted(zooms):
+      print('zoom %s %s'%(zoom,' '.join(['%s:%s'%(name,zooms[zoom][name]) for name in CLASSES])))
+      for name in totals:
+         totals[name] += zooms[zoom][name]
+   print('total %s'%' '.join(['%s:%s'%(name,totals[name]) for name in CLASSES]))
+
+   if report:
+      with open(report,'w') as report_fp:
+         report_fp.write(json.dumps({ 'mbtiles': path, 'zooms': zooms, 'totals': totals,
+            'bad': bad_tiles }, indent=2))
+   if queue:
+      with open(queue,'w') as queue_fp:
+         # tiny tiles are reported, they are good enough to keep
+         for (zoom, tileX, tileY, result) in sorted(bad_tiles):
+            if result in GOOD:
+               continue
+            queue_fp.write('%s,%s,%s\n'%(zoom,tileX,tileY))
+   return zooms
+
+def read_queue(queue=QUEUE):
+   # yields (zoom, x, y) from a queue written by scan()
+   with open(queue,'r') as queue_fp:
+      for line in queue_fp:
+         fields = line.strip().split(',')
+         if len(fields) >= 3:
+            yield (int(fields[0]), int(fields[1]), int(fields[2]))
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Verify the images in an mbtiles.")
+   parser.add_argument("mbtiles", help="mbtiles filename.")
+   parser.add_argument("-w", "--workers", help="Decoding processes. (Default=cpu count)", type=int)
+   parser.add_argument("-l", "--level", help="How closely to check. (Default=full)", choices=LEVELS, default='full')
+   parser.add_argument("-r", "--report", help="json report. (Default=%s)"%REPORT, default=REPORT)
+   parser.add_argument("-q", "--queue", help="Bad tiles to fetch again. (Default=%s)"%QUEUE, default=QUEUE)
+   return parser.parse_args()
+
+def main():
+   args = parse_args()
+   if not os.path.isdir('./work'):
+      os.mkdir('./work')
+   if not os.path.isfile(args.mbtiles):
+      print('Failed to open %s -- Quitting'%args.mbtiles)
+      sys.exit(1)
+   scan(args.mbtiles, args.workers, args.report, args.queue, args.level)
+
+if __name__ == "__main__":
+   main()
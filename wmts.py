@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# A WMTS tile source on the shared http client, and the hash its tiles are stored under
+
+# WMTS fills the {z}, {x} and {y} of a url template and gets the tile through
+#   httpclient.shared(), paced by the HostLimiter of the template's host.
+# tile_hash is the tile_id of an image, identical tiles share one image row.
+# download.py imports both from here, as do sources.py and tile-dl.py, so
+#   nothing that download.py imports has to import download.py.
+
+import hashlib
+import urllib3
+import httpclient
+from fetch import host_limiter, is_throttled, retry_after
+
+def tile_hash(data):
+   # images are keyed by their content, identical tiles share one image row
+   return hashlib.sha1(data).hexdigest()
+
+class WMTS(object):
+
+   def __init__(self, template, maxsize=10, rate=None):
+      # maxsize should be at least the number of fetch workers
+      #   rate is the requests per second allowed to the template's host
+      self.template = template
+      self.http = httpclient.shared(maxsize)
+      self.limiter = host_limiter(urllib3.util.parse_url(template).host,rate,maxsize)
+
+   def get(self,z,x,y,headers=None):
+      srcurl = "%s"%self.template
+      srcurl = srcurl.replace('{z}',str(z))
+      srcurl = srcurl.replace('{x}',str(x))
+      srcurl = srcurl.replace('{y}',str(y))
+      #print(srcurl[-50:])
+      self.limiter.acquire()
+      try:
+         # throttling statuses are left to the limiter, and to sources.Sources
+         resp = self.http.request("GET",srcurl,headers=headers,retry_status=())
+      except Exception:
+         # a dead mirror is not a busy one, sources.Sources fails over
+         self.limiter.release(failed=True)
+         raise
+      self.limiter.release(is_throttled(resp),retry_after(resp))
+      return(resp)